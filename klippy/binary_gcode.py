@@ -0,0 +1,149 @@
+# Pre-tokenized binary g-code file format
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import struct
+import chelper
+
+# A binary g-code file starts with a header followed by one record per
+# g-code line.  A move record holds a plain G0/G1 command (the record
+# type is the command number) followed by a byte with a bit for each
+# X, Y, Z, E, F parameter present and then a double for each present
+# parameter.  A text record holds any other line (without its trailing
+# newline) as a 32bit length followed by the raw text.  Integers and
+# doubles are stored in little-endian order.
+MAGIC = "KLBGCODE"
+VERSION = 1
+HEADER_FORMAT = "<8sI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_G0, RECORD_G1, RECORD_TEXT = 0, 1, 2
+MOVE_AXES = "XYZEF"
+MOVE_CMDS = ('G0', 'G1')
+
+MASK_AXES = ["".join([a for i, a in enumerate(MOVE_AXES) if m & (1 << i)])
+             for m in range(1 << len(MOVE_AXES))]
+MASK_FORMATS = ["<" + "d" * len(axes) for axes in MASK_AXES]
+TEXT_LENGTH = struct.Struct("<I")
+
+class error(Exception):
+    pass
+
+def is_binary(data):
+    return data.startswith(MAGIC)
+
+def format_float(value):
+    # Shortest exact representation (without an exponent, as exponents
+    # are not accepted by the g-code tokenizer)
+    out = repr(value)
+    epos = out.find('e')
+    if epos >= 0:
+        digits = max(17 - int(out[epos+1:]), 1)
+        out = ("%.*f" % (digits, value)).rstrip('0')
+    return out
+
+def format_move(cmd, params):
+    # Generate g-code text for a move (for error reports and fallbacks)
+    return " ".join([cmd] + [a + format_float(params[a])
+                             for a in MOVE_AXES if a in params])
+
+
+######################################################################
+# Decoding
+######################################################################
+
+def decode_records(data):
+    # Decode the complete records in a block of data.  Returns lists
+    # of text lines (an empty string for moves), parsed moves (or None
+    # for text), record sizes, and the number of bytes used.
+    lines = []
+    moves = []
+    sizes = []
+    pos = 0
+    end = len(data)
+    while pos + 1 < end:
+        rtype = ord(data[pos])
+        if rtype == RECORD_TEXT:
+            if pos + 5 > end:
+                break
+            rec_end = pos + 5 + TEXT_LENGTH.unpack_from(data, pos + 1)[0]
+            if rec_end > end:
+                break
+            lines.append(data[pos+5:rec_end])
+            moves.append(None)
+        elif rtype <= RECORD_G1:
+            mask = ord(data[pos+1])
+            if mask >= len(MASK_AXES):
+                raise error("Invalid move record at offset %d" % (pos,))
+            axes = MASK_AXES[mask]
+            rec_end = pos + 2 + 8 * len(axes)
+            if rec_end > end:
+                break
+            values = struct.unpack_from(MASK_FORMATS[mask], data, pos + 2)
+            lines.append("")
+            moves.append((MOVE_CMDS[rtype], dict(zip(axes, values))))
+        else:
+            raise error("Invalid record type %d at offset %d" % (rtype, pos))
+        sizes.append(rec_end - pos)
+        pos = rec_end
+    return lines, moves, sizes, pos
+
+def decode_to_text(data):
+    # Convert the records of a binary file back to g-code text
+    if not is_binary(data):
+        raise error("Not a binary g-code file")
+    lines, moves, sizes, pos = decode_records(data[HEADER_SIZE:])
+    if pos != len(data) - HEADER_SIZE:
+        raise error("Truncated binary g-code file")
+    out = [line if move is None else format_move(*move)
+           for line, move in zip(lines, moves)]
+    return "".join([l + "\n" for l in out])
+
+
+######################################################################
+# Encoding
+######################################################################
+
+def encode_move(cmd_num, params):
+    mask = 0
+    values = []
+    for i, axis in enumerate(MOVE_AXES):
+        if axis in params:
+            mask |= 1 << i
+            values.append(params[axis])
+    return (chr(cmd_num) + chr(mask)
+            + struct.pack(MASK_FORMATS[mask], *values))
+
+def encode_text(line):
+    return chr(RECORD_TEXT) + TEXT_LENGTH.pack(len(line)) + line
+
+def encode(data):
+    # Convert g-code text to the binary format.  Lines that the g-code
+    # dispatcher would pass to its G0/G1 fast path are stored as move
+    # records.  A final line without a trailing newline is not run
+    # when printing, and so it is not stored.
+    ffi_main, ffi_lib = chelper.get_ffi()
+    lines = data.split('\n')
+    lines.pop()
+    count = len(lines)
+    tokens = ffi_main.new('struct gcode_line[]', max(count, 1))
+    num = ffi_lib.gcode_tokenize(tokens, count, data, len(data))
+    moves = [None] * count
+    for i in range(num):
+        t = tokens[i]
+        if t.cmd != 'G' or t.cmd_num > 1:
+            continue
+        letters = ffi_main.string(t.param_letters)
+        if letters.strip(MOVE_AXES):
+            continue
+        params = dict(zip(letters, t.param_values))
+        if params.get('F', 1.) <= 0.:
+            continue
+        moves[t.line] = (t.cmd_num, params)
+    out = [struct.pack(HEADER_FORMAT, MAGIC, VERSION)]
+    for line, move in zip(lines, moves):
+        if move is None:
+            out.append(encode_text(line))
+        else:
+            out.append(encode_move(*move))
+    return "".join(out)
@@ -20,12 +20,12 @@ SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c', 'trapq.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c', 'kin_extruder.c',
-    'kin_shaper.c',
+    'kin_shaper.c', 'kin_bed_mesh.c', 'gcode_parse.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
-    'trapq.h',
+    'trapq.h', 'gcode_parse.h',
 ]
 
 defs_stepcompress = """
@@ -47,6 +47,11 @@ defs_stepcompress = """
 """
 
 defs_itersolve = """
+    struct itersolve_profile {
+        double time, max_time, wall_time;
+        uint64_t count;
+    };
+
     int32_t itersolve_generate_steps(struct stepper_kinematics *sk
         , double flush_time);
     double itersolve_check_active(struct stepper_kinematics *sk
@@ -60,14 +65,35 @@ defs_itersolve = """
     void itersolve_set_position(struct stepper_kinematics *sk
         , double x, double y, double z);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    void itersolve_set_analytic(struct stepper_kinematics *sk, int enable);
+    void itersolve_set_profiling(int enable);
+    void itersolve_get_profile(struct itersolve_profile *p);
+    struct itersolve_shared *itersolve_shared_alloc(void);
+    void itersolve_shared_free(struct itersolve_shared *ss);
+    void itersolve_set_shared(struct stepper_kinematics *sk
+        , struct itersolve_shared *ss);
+    struct itersolve_pool *itersolve_pool_alloc(int num_threads);
+    void itersolve_pool_free(struct itersolve_pool *ip);
+    void itersolve_pool_begin(struct itersolve_pool *ip);
+    int32_t itersolve_pool_flush(struct itersolve_pool *ip);
 """
 
 defs_trapq = """
+    struct append_move {
+        double print_time;
+        double accel_t, cruise_t, decel_t;
+        double start_pos_x, start_pos_y, start_pos_z;
+        double axes_r_x, axes_r_y, axes_r_z;
+        double start_v, cruise_v, accel;
+    };
+
     void trapq_append(struct trapq *tq, double print_time
         , double accel_t, double cruise_t, double decel_t
         , double start_pos_x, double start_pos_y, double start_pos_z
         , double axes_r_x, double axes_r_y, double axes_r_z
         , double start_v, double cruise_v, double accel);
+    void trapq_append_moves(struct trapq *tq, struct append_move *moves
+        , int count);
     struct trapq *trapq_alloc(void);
     void trapq_free(struct trapq *tq);
     void trapq_free_moves(struct trapq *tq, double print_time);
@@ -132,6 +158,18 @@ defs_kin_shaper = """
     struct stepper_kinematics * input_shaper_alloc(void);
 """
 
+defs_kin_bed_mesh = """
+    int bed_mesh_set_sk(struct stepper_kinematics *sk
+        , struct stepper_kinematics *orig_sk);
+    int bed_mesh_set_mesh(struct stepper_kinematics *sk, double *coeffs
+        , int x_count, int y_count, double x_min, double y_min
+        , double x_dist, double y_dist, double mesh_offset);
+    void bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+        , double fade_end, double fade_dist);
+    struct stepper_kinematics * bed_mesh_alloc(void);
+    void bed_mesh_free(struct stepper_kinematics *sk);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -155,6 +193,7 @@ defs_serialqueue = """
         , double baud_adjust);
     void serialqueue_set_receive_window(struct serialqueue *sq
         , int receive_window);
+    void serialqueue_set_write_buffer(struct serialqueue *sq, int size);
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
         , double last_clock_time, uint64_t last_clock);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
@@ -167,6 +206,19 @@ defs_pyhelper = """
     double get_monotonic(void);
 """
 
+defs_gcode_parse = """
+    struct gcode_line {
+        int32_t line, offset;
+        char cmd;
+        int32_t cmd_num, num_params;
+        char param_letters[8];
+        double param_values[8];
+    };
+
+    int gcode_tokenize(struct gcode_line *lines, int max_lines
+        , const char *data, int len);
+"""
+
 defs_std = """
     void free(void*);
 """
@@ -175,7 +227,8 @@ defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
     defs_itersolve, defs_trapq, defs_kin_cartesian, defs_kin_corexy,
     defs_kin_corexz, defs_kin_delta, defs_kin_polar, defs_kin_rotary_delta,
-    defs_kin_winch, defs_kin_extruder, defs_kin_shaper,
+    defs_kin_winch, defs_kin_extruder, defs_kin_shaper, defs_kin_bed_mesh,
+    defs_gcode_parse,
 ]
 
 # Return the list of file modification times
@@ -0,0 +1,179 @@
+// Fast tokenizing of "traditional" g-code input lines
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // strtod
+#include <string.h> // memchr
+#include "compiler.h" // __visible
+#include "gcode_parse.h" // gcode_tokenize
+
+static inline int
+is_space(char c)
+{
+    return c == ' ' || c == '\t' || c == '\r' || c == '\v' || c == '\f';
+}
+
+static inline int
+is_digit(char c)
+{
+    return c >= '0' && c <= '9';
+}
+
+static inline char
+to_upper(char c)
+{
+    return c >= 'a' && c <= 'z' ? c - 'a' + 'A' : c;
+}
+
+// Parse a plain decimal number ("[-+]?[0-9]+.?[0-9]*" or "[-+]?.[0-9]+")
+static const char *
+parse_number(const char *p, const char *end, double *value)
+{
+    const char *start = p;
+    if (p < end && (*p == '-' || *p == '+'))
+        p++;
+    int digits = 0;
+    while (p < end && is_digit(*p))
+        p++, digits++;
+    if (p < end && *p == '.') {
+        p++;
+        while (p < end && is_digit(*p))
+            p++, digits++;
+    }
+    if (!digits)
+        return NULL;
+    // Copy to a buffer so strtod() can't parse past the validated text
+    char buf[64];
+    int len = p - start;
+    if (len >= sizeof(buf))
+        return NULL;
+    memcpy(buf, start, len);
+    buf[len] = '\0';
+    *value = strtod(buf, NULL);
+    return p;
+}
+
+// Parse an unsigned integer (without leading zeros)
+static const char *
+parse_int(const char *p, const char *end, int32_t *value)
+{
+    if (p >= end || !is_digit(*p) || (*p == '0' && p + 1 < end
+                                      && is_digit(p[1])))
+        return NULL;
+    int32_t v = 0;
+    while (p < end && is_digit(*p)) {
+        if (v >= 100000000)
+            return NULL;
+        v = v * 10 + *p++ - '0';
+    }
+    *value = v;
+    return p;
+}
+
+// A command or parameter must be followed by a space, a letter, a
+// checksum, or the end of the line
+static inline int
+is_separator(const char *p, const char *end)
+{
+    if (p >= end)
+        return 1;
+    char c = to_upper(*p);
+    return is_space(c) || c == '*' || (c >= 'A' && c <= 'Z');
+}
+
+static const char *
+skip_space(const char *p, const char *end)
+{
+    while (p < end && is_space(*p))
+        p++;
+    return p;
+}
+
+// Parse a single line - returns 0 if the line is a traditional
+// command with only single letter numeric parameters
+static int
+parse_line(struct gcode_line *gl, const char *p, const char *end)
+{
+    // Remove comments and whitespace
+    const char *cpos = memchr(p, ';', end - p);
+    if (cpos)
+        end = cpos;
+    p = skip_space(p, end);
+    while (end > p && is_space(end[-1]))
+        end--;
+    if (p >= end)
+        return -1;
+    // Skip any line number
+    int32_t num;
+    if (to_upper(*p) == 'N') {
+        p = parse_int(p + 1, end, &num);
+        if (!p || !is_separator(p, end))
+            return -1;
+        p = skip_space(p, end);
+        if (p >= end)
+            return -1;
+    }
+    // Command
+    char cmd = to_upper(*p);
+    if (cmd < 'A' || cmd > 'Z' || cmd == 'N')
+        return -1;
+    p = parse_int(p + 1, end, &gl->cmd_num);
+    if (!p || !is_separator(p, end))
+        return -1;
+    gl->cmd = cmd;
+    // Parameters
+    int count = 0;
+    for (;;) {
+        p = skip_space(p, end);
+        if (p >= end)
+            break;
+        char c = to_upper(*p);
+        if (c == '*') {
+            // Checksum (not verified) must be at the end of the line
+            p = parse_int(p + 1, end, &num);
+            if (!p || skip_space(p, end) < end)
+                return -1;
+            break;
+        }
+        if (c < 'A' || c > 'Z' || count >= GCODE_MAX_PARAMS)
+            return -1;
+        p = parse_number(p + 1, end, &gl->param_values[count]);
+        if (!p || !is_separator(p, end))
+            return -1;
+        gl->param_letters[count++] = c;
+    }
+    gl->num_params = count;
+    if (count < GCODE_MAX_PARAMS)
+        gl->param_letters[count] = '\0';
+    return 0;
+}
+
+// Tokenize all complete lines in a buffer.  A record is stored for
+// each line that is a traditional command (a letter followed by an
+// integer) with only single letter numeric parameters.  Other lines
+// (eg, extended commands, string parameters, and empty lines) have no
+// record and must be handled by the caller.  Returns the number of
+// records stored.
+int __visible
+gcode_tokenize(struct gcode_line *lines, int max_lines
+               , const char *data, int len)
+{
+    const char *p = data, *end = data + len;
+    int count = 0, line = 0;
+    while (count < max_lines) {
+        const char *eol = memchr(p, '\n', end - p);
+        if (!eol)
+            break;
+        struct gcode_line *gl = &lines[count];
+        if (!parse_line(gl, p, eol)) {
+            gl->line = line;
+            gl->offset = p - data;
+            count++;
+        }
+        p = eol + 1;
+        line++;
+    }
+    return count;
+}
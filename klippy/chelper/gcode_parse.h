@@ -0,0 +1,19 @@
+#ifndef GCODE_PARSE_H
+#define GCODE_PARSE_H
+
+#include <stdint.h> // int32_t
+
+#define GCODE_MAX_PARAMS 8
+
+struct gcode_line {
+    int32_t line, offset;
+    char cmd;
+    int32_t cmd_num, num_params;
+    char param_letters[GCODE_MAX_PARAMS];
+    double param_values[GCODE_MAX_PARAMS];
+};
+
+int gcode_tokenize(struct gcode_line *lines, int max_lines
+                   , const char *data, int len);
+
+#endif // gcode_parse.h
@@ -4,8 +4,11 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
+#include <errno.h> // ENOMEM
 #include <math.h> // fabs
+#include <pthread.h> // pthread_mutex_lock
 #include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
 #include <string.h> // memset
 #include "compiler.h" // __visible
 #include "itersolve.h" // itersolve_generate_steps
@@ -68,6 +71,51 @@ itersolve_find_step(struct stepper_kinematics *sk, struct move *m
     return best_guess;
 }
 
+// Steps generated by a leader of a shared group (see below)
+struct shared_step {
+    double print_time, step_time;
+    int sdir; // -1 for a stepcompress_commit()
+};
+
+struct itersolve_shared {
+    struct stepper_kinematics *leader;
+    // State of the leader for the last recorded steps
+    int valid, overflow;
+    struct trapq *tq;
+    double step_dist;
+    int active_flags, start_sdir;
+    double gen_steps_pre_active, gen_steps_post_active;
+    sk_calc_callback calc_position_cb;
+    sk_poly_callback calc_poly_cb;
+    double start_flush_time, start_pos, start_move_time;
+    double flush_time, end_pos, end_move_time;
+    // Recorded steps
+    struct shared_step *steps;
+    int step_count, step_alloc;
+};
+
+// Note a step generated by the leader
+static void
+shared_record(struct itersolve_shared *ss, int sdir
+              , double print_time, double step_time)
+{
+    if (unlikely(ss->step_count >= ss->step_alloc)) {
+        int new_alloc = ss->step_alloc ? ss->step_alloc * 2 : 1024;
+        struct shared_step *steps = realloc(
+            ss->steps, new_alloc * sizeof(*steps));
+        if (!steps) {
+            ss->overflow = 1;
+            return;
+        }
+        ss->steps = steps;
+        ss->step_alloc = new_alloc;
+    }
+    struct shared_step *st = &ss->steps[ss->step_count++];
+    st->print_time = print_time;
+    st->step_time = step_time;
+    st->sdir = sdir;
+}
+
 #define SEEK_TIME_RESET 0.000100
 
 // Generate step times for a portion of a move
@@ -76,6 +124,9 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
                           , double abs_start, double abs_end)
 {
     sk_calc_callback calc_position_cb = sk->calc_position_cb;
+    struct itersolve_shared *record = sk->shared;
+    if (record && record->leader != sk)
+        record = NULL;
     double half_step = .5 * sk->step_dist;
     double start = abs_start - m->print_time, end = abs_end - m->print_time;
     if (start < 0.)
@@ -96,6 +147,8 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
                                           , m->print_time, next.time);
             if (ret)
                 return ret;
+            if (unlikely(record))
+                shared_record(record, sdir, m->print_time, next.time);
             seek_time_delta = next.time - last.time;
             if (seek_time_delta < .000000001)
                 seek_time_delta = .000000001;
@@ -111,6 +164,8 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
         } else if (dist > 0.) {
             // Avoid rollback if stepper fully reaches target position
             stepcompress_commit(sk->sc);
+            if (unlikely(record))
+                shared_record(record, -1, 0., 0.);
         } else if (unlikely(dist < -(half_step + .000000001))) {
             // Found direction change
             is_dir_change = 1;
@@ -149,6 +204,119 @@ itersolve_gen_steps_range(struct stepper_kinematics *sk, struct move *m
 }
 
 
+/****************************************************************
+ * Analytic solver
+ ****************************************************************/
+
+// Kinematics where the stepper position is a linear combination of
+// the cartesian coordinates may provide a calc_poly_cb callback.  The
+// position is then a quadratic in time during each move, and step
+// times can be calculated directly (if enabled with
+// itersolve_set_analytic()).  This follows the same stepping
+// rules as the iterative solver above (steps at each half step
+// boundary, and a direction change only after moving more than half
+// a step back).
+
+// Return the position polynomial for a given linear combination of axes
+struct sk_poly
+itersolve_linear_poly(struct move *m, double x, double y, double z)
+{
+    double r = m->axes_r.x * x + m->axes_r.y * y + m->axes_r.z * z;
+    return (struct sk_poly){
+        m->start_pos.x * x + m->start_pos.y * y + m->start_pos.z * z,
+        r * m->start_v, r * m->half_accel };
+}
+
+// Generate step times for a portion of a move using sk->calc_poly_cb
+static int32_t
+itersolve_gen_steps_poly(struct stepper_kinematics *sk, struct move *m
+                         , double abs_start, double abs_end)
+{
+    struct itersolve_shared *record = sk->shared;
+    if (record && record->leader != sk)
+        record = NULL;
+    double half_step = .5 * sk->step_dist;
+    double start = abs_start - m->print_time, end = abs_end - m->print_time;
+    if (start < 0.)
+        start = 0.;
+    if (end > m->move_t)
+        end = m->move_t;
+    struct sk_poly p = sk->calc_poly_cb(sk, m);
+    double last_position = sk->commanded_pos;
+    int sdir = stepcompress_get_step_dir(sk->sc);
+    // Split the range at the point the stepper changes direction
+    double seg_ends[2];
+    int seg_count = 0;
+    if (p.c2) {
+        double turn_time = -p.c1 / (2. * p.c2);
+        if (turn_time > start && turn_time < end)
+            seg_ends[seg_count++] = turn_time;
+    }
+    seg_ends[seg_count++] = end;
+    double seg_start = start;
+    int i;
+    for (i=0; i<seg_count; i++) {
+        double seg_end = seg_ends[i];
+        double mid_v = p.c1 + p.c2 * (seg_start + seg_end);
+        double end_pos = p.c0 + (p.c1 + p.c2 * seg_end) * seg_end;
+        if (mid_v) {
+            // Position along direction of travel is: pos + v*t + a*t^2
+            int dir = mid_v > 0.;
+            double sign = dir ? 1. : -1., step = sign * half_step;
+            double pos = p.c0 + (p.c1 + p.c2 * seg_start) * seg_start;
+            double v = sign * (p.c1 + 2. * p.c2 * seg_start), a = sign * p.c2;
+            if (v < 0.)
+                v = 0.;
+            for (;;) {
+                double target = last_position + step;
+                double dist = sign * (end_pos - target);
+                if (dir == sdir ? dist < 0. : dist <= .000000001)
+                    break;
+                // Solve a*t^2 + v*t - delta = 0 (numerically stable form)
+                double delta = sign * (target - pos), step_time = seg_start;
+                if (delta > 0.) {
+                    double disc = v*v + 4. * a * delta;
+                    double denom = v + (disc > 0. ? sqrt(disc) : 0.);
+                    if (denom > 0.)
+                        step_time += 2. * delta / denom;
+                    if (step_time > seg_end)
+                        step_time = seg_end;
+                }
+                int ret = stepcompress_append(sk->sc, dir
+                                              , m->print_time, step_time);
+                if (ret)
+                    return ret;
+                if (unlikely(record))
+                    shared_record(record, dir, m->print_time, step_time);
+                sdir = dir;
+                last_position = target + step;
+            }
+        }
+        if ((sdir ? end_pos - last_position : last_position - end_pos) > 0.) {
+            // Avoid rollback if stepper fully reaches target position
+            stepcompress_commit(sk->sc);
+            if (unlikely(record))
+                shared_record(record, -1, 0., 0.);
+        }
+        seg_start = seg_end;
+    }
+    sk->commanded_pos = last_position;
+    if (sk->post_cb)
+        sk->post_cb(sk);
+    return 0;
+}
+
+// Generate step times for a portion of a move
+static int32_t
+gen_steps_range(struct stepper_kinematics *sk, struct move *m
+                , double abs_start, double abs_end)
+{
+    if (sk->use_poly && sk->calc_poly_cb)
+        return itersolve_gen_steps_poly(sk, m, abs_start, abs_end);
+    return itersolve_gen_steps_range(sk, m, abs_start, abs_end);
+}
+
+
 /****************************************************************
  * Interface functions
  ****************************************************************/
@@ -163,9 +331,16 @@ check_active(struct stepper_kinematics *sk, struct move *m)
             || (af & AF_Z && m->axes_r.z != 0.));
 }
 
+static struct itersolve_pool *active_pool;
+static int32_t itersolve_pool_queue(struct itersolve_pool *ip
+                                    , struct stepper_kinematics *sk
+                                    , double flush_time);
+static int32_t shared_generate_steps(struct stepper_kinematics *sk
+                                     , double flush_time);
+
 // Generate step times for a range of moves on the trapq
-int32_t __visible
-itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
+static int32_t
+solve_steps(struct stepper_kinematics *sk, double flush_time)
 {
     double last_flush_time = sk->last_flush_time;
     sk->last_flush_time = flush_time;
@@ -191,16 +366,15 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
                 while (--skip_count && pm->print_time > abs_start)
                     pm = list_prev_entry(pm, node);
                 do {
-                    int32_t ret = itersolve_gen_steps_range(sk, pm, abs_start
-                                                            , flush_time);
+                    int32_t ret = gen_steps_range(sk, pm, abs_start
+                                                  , flush_time);
                     if (ret)
                         return ret;
                     pm = list_next_entry(pm, node);
                 } while (pm != m);
             }
             // Generate steps for this move
-            int32_t ret = itersolve_gen_steps_range(sk, m, last_flush_time
-                                                    , flush_time);
+            int32_t ret = gen_steps_range(sk, m, last_flush_time, flush_time);
             if (ret)
                 return ret;
             if (move_end >= flush_time) {
@@ -216,8 +390,8 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
                 double abs_end = force_steps_time;
                 if (abs_end > flush_time)
                     abs_end = flush_time;
-                int32_t ret = itersolve_gen_steps_range(sk, m, last_flush_time
-                                                        , abs_end);
+                int32_t ret = gen_steps_range(sk, m, last_flush_time
+                                              , abs_end);
                 if (ret)
                     return ret;
                 skip_count = 1;
@@ -232,6 +406,55 @@ itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
     }
 }
 
+// Generate step times (possibly using the steps of a shared leader)
+static int32_t
+generate_steps(struct stepper_kinematics *sk, double flush_time)
+{
+    if (sk->shared)
+        return shared_generate_steps(sk, flush_time);
+    return solve_steps(sk, flush_time);
+}
+
+// Optional timing of step generation
+static int profiling;
+static struct itersolve_profile profile;
+
+// Generate step times for a range of moves on the trapq
+int32_t __visible
+itersolve_generate_steps(struct stepper_kinematics *sk, double flush_time)
+{
+    if (active_pool)
+        // Defer to a worker thread (see itersolve_pool_flush() below)
+        return itersolve_pool_queue(active_pool, sk, flush_time);
+    if (!profiling)
+        return generate_steps(sk, flush_time);
+    double start_time = get_monotonic();
+    int32_t ret = generate_steps(sk, flush_time);
+    double run_time = get_monotonic() - start_time;
+    profile.time += run_time;
+    profile.wall_time += run_time;
+    if (run_time > profile.max_time)
+        profile.max_time = run_time;
+    profile.count++;
+    return ret;
+}
+
+// Enable (or disable) step generation timing
+void __visible
+itersolve_set_profiling(int enable)
+{
+    profiling = enable;
+}
+
+// Report the cumulative step generation time (summed over all threads
+// and as spent by the calling thread), the longest single call, and
+// the number of calls
+void __visible
+itersolve_get_profile(struct itersolve_profile *p)
+{
+    *p = profile;
+}
+
 // Check if the given stepper is likely to be active in the given time range
 double __visible
 itersolve_check_active(struct stepper_kinematics *sk, double flush_time)
@@ -299,3 +522,378 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+// Use the analytic solver (if the kinematics provide a calc_poly_cb)
+void __visible
+itersolve_set_analytic(struct stepper_kinematics *sk, int enable)
+{
+    sk->use_poly = enable;
+}
+
+
+/****************************************************************
+ * Shared step generation
+ ****************************************************************/
+
+// Steppers with identical kinematics (eg, multiple z steppers on the
+// same rail) would calculate identical step times.  The "leader" of
+// an itersolve_shared group records the steps it generates and the
+// other steppers in the group replay those steps into their own
+// stepcompress queue when they are in the same state as the leader
+// was.  Steppers not in the same state (or if the leader did not
+// generate steps for the same time range) use the iterative solver.
+
+// Generate steps on the leader while recording them
+static int32_t
+shared_leader_generate(struct itersolve_shared *ss
+                       , struct stepper_kinematics *sk, double flush_time)
+{
+    ss->valid = ss->overflow = ss->step_count = 0;
+    ss->tq = sk->tq;
+    ss->step_dist = sk->step_dist;
+    ss->active_flags = sk->active_flags;
+    ss->start_sdir = sk->sc ? stepcompress_get_step_dir(sk->sc) : 0;
+    ss->gen_steps_pre_active = sk->gen_steps_pre_active;
+    ss->gen_steps_post_active = sk->gen_steps_post_active;
+    ss->calc_position_cb = sk->calc_position_cb;
+    ss->calc_poly_cb = sk->use_poly ? sk->calc_poly_cb : NULL;
+    ss->start_flush_time = sk->last_flush_time;
+    ss->start_pos = sk->commanded_pos;
+    ss->start_move_time = sk->last_move_time;
+    int32_t ret = solve_steps(sk, flush_time);
+    if (ret || ss->overflow || !sk->tq || sk->post_cb)
+        return ret;
+    ss->flush_time = flush_time;
+    ss->end_pos = sk->commanded_pos;
+    ss->end_move_time = sk->last_move_time;
+    ss->valid = 1;
+    return 0;
+}
+
+// Check if a follower would generate the same steps as the leader
+static int
+shared_check(struct itersolve_shared *ss, struct stepper_kinematics *sk
+             , double flush_time)
+{
+    return (ss->valid && sk->tq == ss->tq && sk->sc && !sk->post_cb
+            && ss->flush_time == flush_time
+            && ss->start_flush_time == sk->last_flush_time
+            && ss->start_pos == sk->commanded_pos
+            && ss->start_move_time == sk->last_move_time
+            && ss->step_dist == sk->step_dist
+            && ss->active_flags == sk->active_flags
+            && ss->calc_position_cb == sk->calc_position_cb
+            && ss->calc_poly_cb == (sk->use_poly ? sk->calc_poly_cb : NULL)
+            && ss->gen_steps_pre_active == sk->gen_steps_pre_active
+            && ss->gen_steps_post_active == sk->gen_steps_post_active
+            && ss->start_sdir == stepcompress_get_step_dir(sk->sc));
+}
+
+// Add the steps recorded by the leader to a follower
+static int32_t
+shared_replay(struct itersolve_shared *ss, struct stepper_kinematics *sk)
+{
+    struct stepcompress *sc = sk->sc;
+    struct shared_step *st = ss->steps, *end = &ss->steps[ss->step_count];
+    for (; st < end; st++) {
+        int ret;
+        if (st->sdir < 0)
+            ret = stepcompress_commit(sc);
+        else
+            ret = stepcompress_append(sc, st->sdir
+                                      , st->print_time, st->step_time);
+        if (ret)
+            return ret;
+    }
+    sk->last_flush_time = ss->flush_time;
+    sk->commanded_pos = ss->end_pos;
+    sk->last_move_time = ss->end_move_time;
+    return 0;
+}
+
+static int32_t
+shared_generate_steps(struct stepper_kinematics *sk, double flush_time)
+{
+    struct itersolve_shared *ss = sk->shared;
+    if (ss->leader == sk)
+        return shared_leader_generate(ss, sk, flush_time);
+    if (shared_check(ss, sk, flush_time))
+        return shared_replay(ss, sk);
+    return solve_steps(sk, flush_time);
+}
+
+struct itersolve_shared * __visible
+itersolve_shared_alloc(void)
+{
+    struct itersolve_shared *ss = malloc(sizeof(*ss));
+    memset(ss, 0, sizeof(*ss));
+    return ss;
+}
+
+void __visible
+itersolve_shared_free(struct itersolve_shared *ss)
+{
+    if (!ss)
+        return;
+    free(ss->steps);
+    free(ss);
+}
+
+// Add a stepper to a shared step group (the first stepper is the leader)
+void __visible
+itersolve_set_shared(struct stepper_kinematics *sk
+                     , struct itersolve_shared *ss)
+{
+    sk->shared = ss;
+    if (ss && !ss->leader)
+        ss->leader = sk;
+    if (ss)
+        ss->valid = 0;
+}
+
+
+/****************************************************************
+ * Parallel step generation
+ ****************************************************************/
+
+// Each stepper_kinematics only writes to its own state and its own
+// stepcompress queue, so steps for different steppers may be
+// generated concurrently.  Between itersolve_pool_begin() and
+// itersolve_pool_flush() calls to itersolve_generate_steps() are
+// queued, and itersolve_pool_flush() then runs them on a set of
+// worker threads (and the calling thread) and waits for completion.
+// The jobs array is only updated by the calling thread while no jobs
+// are published to the workers (run_count is zero).
+
+struct pool_job {
+    struct stepper_kinematics *sk;
+    double flush_time;
+    int is_follower, next_follower;
+};
+
+struct itersolve_pool {
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t cond, done_cond;
+    pthread_t *threads;
+    int num_threads, exit;
+    struct pool_job *jobs;
+    int jobs_alloc, job_count; // only used by the calling thread
+    int run_count, next_job, jobs_done;
+    uint32_t generation;
+    int32_t result;
+};
+
+// Queue a stepper for step generation on the next pool flush
+static int32_t
+itersolve_pool_queue(struct itersolve_pool *ip, struct stepper_kinematics *sk
+                     , double flush_time)
+{
+    int i, leader_job = -1;
+    for (i=0; i<ip->job_count; i++) {
+        if (ip->jobs[i].sk == sk)
+            // Already queued - a repeat request can't generate new steps
+            return 0;
+        if (sk->shared && ip->jobs[i].sk == sk->shared->leader)
+            leader_job = i;
+    }
+    if (ip->job_count >= ip->jobs_alloc) {
+        int new_alloc = ip->jobs_alloc ? ip->jobs_alloc * 2 : 16;
+        struct pool_job *jobs = realloc(ip->jobs, new_alloc * sizeof(*jobs));
+        if (!jobs) {
+            errorf("itersolve_pool: out of memory");
+            return -1;
+        }
+        ip->jobs = jobs;
+        ip->jobs_alloc = new_alloc;
+    }
+    // Update the trapq sentinels here as the trapq is shared between threads
+    if (sk->tq)
+        trapq_check_sentinels(sk->tq);
+    struct pool_job *job = &ip->jobs[ip->job_count];
+    job->sk = sk;
+    job->flush_time = flush_time;
+    job->is_follower = 0;
+    job->next_follower = -1;
+    if (leader_job >= 0) {
+        // Run after the leader (on the same thread) so its steps can be reused
+        job->is_follower = 1;
+        job->next_follower = ip->jobs[leader_job].next_follower;
+        ip->jobs[leader_job].next_follower = ip->job_count;
+    }
+    ip->job_count++;
+    return 0;
+}
+
+// Run queued jobs until none remain (must be called with lock held)
+static void
+pool_run_jobs(struct itersolve_pool *ip)
+{
+    while (ip->next_job < ip->run_count) {
+        struct pool_job *job = &ip->jobs[ip->next_job++];
+        if (job->is_follower)
+            // Run along with its leader
+            continue;
+        pthread_mutex_unlock(&ip->lock);
+        double start_time = profiling ? get_monotonic() : 0.;
+        int32_t ret = generate_steps(job->sk, job->flush_time);
+        int count = 1, f;
+        for (f = job->next_follower; f >= 0; f = ip->jobs[f].next_follower) {
+            int32_t fret = generate_steps(ip->jobs[f].sk, job->flush_time);
+            if (fret && !ret)
+                ret = fret;
+            count++;
+        }
+        double end_time = profiling ? get_monotonic() : 0.;
+        pthread_mutex_lock(&ip->lock);
+        if (profiling) {
+            double run_time = end_time - start_time;
+            profile.time += run_time;
+            if (run_time > profile.max_time)
+                profile.max_time = run_time;
+            profile.count += count;
+        }
+        if (ret && !ip->result)
+            ip->result = ret;
+        ip->jobs_done += count;
+        if (ip->jobs_done >= ip->run_count)
+            pthread_cond_signal(&ip->done_cond);
+    }
+}
+
+// Main code for each worker thread
+static void *
+pool_thread(void *data)
+{
+    struct itersolve_pool *ip = data;
+    pthread_mutex_lock(&ip->lock);
+    uint32_t generation = ip->generation;
+    for (;;) {
+        while (!ip->exit && generation == ip->generation)
+            pthread_cond_wait(&ip->cond, &ip->lock);
+        if (ip->exit)
+            break;
+        generation = ip->generation;
+        pool_run_jobs(ip);
+    }
+    pthread_mutex_unlock(&ip->lock);
+    return NULL;
+}
+
+// Stop and wait for the first count worker threads
+static void
+pool_stop_threads(struct itersolve_pool *ip, int count)
+{
+    pthread_mutex_lock(&ip->lock);
+    ip->exit = 1;
+    pthread_cond_broadcast(&ip->cond);
+    pthread_mutex_unlock(&ip->lock);
+    int i;
+    for (i=0; i<count; i++) {
+        int ret = pthread_join(ip->threads[i], NULL);
+        if (ret)
+            report_errno("pthread_join", ret);
+    }
+}
+
+// Create a pool with the given number of worker threads
+struct itersolve_pool * __visible
+itersolve_pool_alloc(int num_threads)
+{
+    struct itersolve_pool *ip = malloc(sizeof(*ip));
+    if (!ip) {
+        errorf("itersolve_pool_alloc: out of memory");
+        return NULL;
+    }
+    memset(ip, 0, sizeof(*ip));
+    int ret = pthread_mutex_init(&ip->lock, NULL);
+    if (ret)
+        goto fail_lock;
+    ret = pthread_cond_init(&ip->cond, NULL);
+    if (ret)
+        goto fail_cond;
+    ret = pthread_cond_init(&ip->done_cond, NULL);
+    if (ret)
+        goto fail_done_cond;
+    ip->threads = malloc(num_threads * sizeof(*ip->threads));
+    if (!ip->threads) {
+        ret = ENOMEM;
+        goto fail_threads;
+    }
+    for (; ip->num_threads < num_threads; ip->num_threads++) {
+        ret = pthread_create(&ip->threads[ip->num_threads], NULL
+                             , pool_thread, ip);
+        if (ret)
+            goto fail_threads;
+    }
+    return ip;
+
+fail_threads:
+    if (ip->threads)
+        pool_stop_threads(ip, ip->num_threads);
+    free(ip->threads);
+    pthread_cond_destroy(&ip->done_cond);
+fail_done_cond:
+    pthread_cond_destroy(&ip->cond);
+fail_cond:
+    pthread_mutex_destroy(&ip->lock);
+fail_lock:
+    report_errno("itersolve_pool_alloc", ret);
+    free(ip);
+    return NULL;
+}
+
+// Stop all worker threads and free the pool
+void __visible
+itersolve_pool_free(struct itersolve_pool *ip)
+{
+    if (!ip)
+        return;
+    if (active_pool == ip)
+        active_pool = NULL;
+    pool_stop_threads(ip, ip->num_threads);
+    pthread_cond_destroy(&ip->done_cond);
+    pthread_cond_destroy(&ip->cond);
+    pthread_mutex_destroy(&ip->lock);
+    free(ip->threads);
+    free(ip->jobs);
+    free(ip);
+}
+
+// Start queuing itersolve_generate_steps() requests on the pool
+void __visible
+itersolve_pool_begin(struct itersolve_pool *ip)
+{
+    pthread_mutex_lock(&ip->lock);
+    ip->job_count = ip->run_count = ip->next_job = 0;
+    pthread_mutex_unlock(&ip->lock);
+    active_pool = ip;
+}
+
+// Generate steps for all queued requests and wait for completion
+int32_t __visible
+itersolve_pool_flush(struct itersolve_pool *ip)
+{
+    active_pool = NULL;
+    if (!ip->job_count)
+        return 0;
+    double start_time = profiling ? get_monotonic() : 0.;
+    pthread_mutex_lock(&ip->lock);
+    // Publish the queued jobs to the worker threads
+    ip->next_job = ip->jobs_done = 0;
+    ip->run_count = ip->job_count;
+    ip->result = 0;
+    if (ip->job_count > 1) {
+        ip->generation++;
+        pthread_cond_broadcast(&ip->cond);
+    }
+    pool_run_jobs(ip);
+    while (ip->jobs_done < ip->run_count)
+        pthread_cond_wait(&ip->done_cond, &ip->lock);
+    int32_t ret = ip->result;
+    // Withdraw the jobs so no late waking worker can access them
+    ip->job_count = ip->run_count = ip->next_job = 0;
+    if (profiling)
+        profile.wall_time += get_monotonic() - start_time;
+    pthread_mutex_unlock(&ip->lock);
+    return ret;
+}
@@ -1,7 +1,7 @@
 #ifndef ITERSOLVE_H
 #define ITERSOLVE_H
 
-#include <stdint.h> // int32_t
+#include <stdint.h> // int32_t, uint64_t
 
 enum {
     AF_X = 1 << 0, AF_Y = 1 << 1, AF_Z = 1 << 2,
@@ -12,6 +12,12 @@ struct move;
 typedef double (*sk_calc_callback)(struct stepper_kinematics *sk, struct move *m
                                    , double move_time);
 typedef void (*sk_post_callback)(struct stepper_kinematics *sk);
+// Stepper position during a move: c0 + c1*move_time + c2*move_time^2
+struct sk_poly {
+    double c0, c1, c2;
+};
+typedef struct sk_poly (*sk_poly_callback)(struct stepper_kinematics *sk
+                                           , struct move *m);
 struct stepper_kinematics {
     double step_dist, commanded_pos;
     struct stepcompress *sc;
@@ -23,6 +29,17 @@ struct stepper_kinematics {
 
     sk_calc_callback calc_position_cb;
     sk_post_callback post_cb;
+    sk_poly_callback calc_poly_cb;
+    int use_poly;
+
+    struct itersolve_shared *shared;
+};
+
+struct sk_poly itersolve_linear_poly(struct move *m, double x, double y
+                                     , double z);
+struct itersolve_profile {
+    double time, max_time, wall_time;
+    uint64_t count;
 };
 
 int32_t itersolve_generate_steps(struct stepper_kinematics *sk
@@ -37,5 +54,16 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
 void itersolve_set_position(struct stepper_kinematics *sk
                             , double x, double y, double z);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+void itersolve_set_analytic(struct stepper_kinematics *sk, int enable);
+void itersolve_set_profiling(int enable);
+void itersolve_get_profile(struct itersolve_profile *p);
+struct itersolve_shared *itersolve_shared_alloc(void);
+void itersolve_shared_free(struct itersolve_shared *ss);
+void itersolve_set_shared(struct stepper_kinematics *sk
+                          , struct itersolve_shared *ss);
+struct itersolve_pool *itersolve_pool_alloc(int num_threads);
+void itersolve_pool_free(struct itersolve_pool *ip);
+void itersolve_pool_begin(struct itersolve_pool *ip);
+int32_t itersolve_pool_flush(struct itersolve_pool *ip);
 
 #endif // itersolve.h
@@ -0,0 +1,172 @@
+// Bed mesh z compensation applied during step generation
+//
+// Copyright (C) 2026  agent <agent@local>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stddef.h> // offsetof
+#include <stdlib.h> // malloc
+#include <string.h> // memcpy
+#include "compiler.h" // __visible
+#include "itersolve.h" // struct stepper_kinematics
+#include "trapq.h" // move_get_coord
+
+#define DUMMY_T 500.0
+
+struct bed_mesh {
+    struct stepper_kinematics sk;
+    struct stepper_kinematics *orig_sk;
+    struct move m;
+    // Bilinear coefficients (a, b, c, d) of each mesh cell
+    double *coeffs;
+    int x_count, y_count;
+    double x_min, y_min, x_dist, y_dist, mesh_offset;
+    double fade_start, fade_end, fade_dist;
+};
+
+// Find the mesh cell containing a position (positions outside the
+// mesh use the nearest cell)
+static inline int
+mesh_cell(double f, int max_idx)
+{
+    if (f <= 0.)
+        return 0;
+    if (f >= max_idx)
+        return max_idx;
+    return (int)f;
+}
+
+static inline double
+mesh_cell_pos(double f, int idx)
+{
+    double t = f - idx;
+    return t < 0. ? 0. : (t > 1. ? 1. : t);
+}
+
+// Calculate the (non-faded) mesh z adjustment at an xy position
+static double
+mesh_calc_z(struct bed_mesh *bm, double x, double y)
+{
+    double fx = (x - bm->x_min) / bm->x_dist;
+    double fy = (y - bm->y_min) / bm->y_dist;
+    int xidx = mesh_cell(fx, bm->x_count - 2);
+    int yidx = mesh_cell(fy, bm->y_count - 2);
+    double tx = mesh_cell_pos(fx, xidx), ty = mesh_cell_pos(fy, yidx);
+    double *c = &bm->coeffs[(yidx * (bm->x_count - 1) + xidx) * 4];
+    return c[0] + c[1] * tx + (c[2] + c[3] * tx) * ty;
+}
+
+// Scale the mesh adjustment down as the z height approaches fade_end
+static inline double
+mesh_fade_factor(struct bed_mesh *bm, double z)
+{
+    if (z >= bm->fade_end)
+        return 0.;
+    if (z >= bm->fade_start)
+        return (bm->fade_end - z) / bm->fade_dist;
+    return 1.;
+}
+
+static double
+bed_mesh_calc_position(struct stepper_kinematics *sk, struct move *m
+                       , double move_time)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!bm->coeffs)
+        return bm->orig_sk->calc_position_cb(bm->orig_sk, m, move_time);
+    struct coord c = move_get_coord(m, move_time);
+    double factor = mesh_fade_factor(bm, c.z);
+    if (factor)
+        c.z += factor * mesh_calc_z(bm, c.x, c.y);
+    c.z += bm->mesh_offset;
+    bm->m.start_pos = c;
+    return bm->orig_sk->calc_position_cb(bm->orig_sk, &bm->m, DUMMY_T);
+}
+
+// Use the analytic solver of the original kinematics when no mesh is set
+static struct sk_poly
+bed_mesh_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    return bm->orig_sk->calc_poly_cb(bm->orig_sk, m);
+}
+
+static void
+bed_mesh_note_callbacks(struct bed_mesh *bm)
+{
+    bm->sk.calc_poly_cb = NULL;
+    if (!bm->coeffs && bm->orig_sk->calc_poly_cb)
+        bm->sk.calc_poly_cb = bed_mesh_calc_poly;
+}
+
+int __visible
+bed_mesh_set_sk(struct stepper_kinematics *sk
+                , struct stepper_kinematics *orig_sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    if (!(orig_sk->active_flags & AF_Z))
+        return -1;
+    // The z adjustment changes with xy movement
+    bm->sk.active_flags = orig_sk->active_flags | AF_X | AF_Y;
+    bm->sk.gen_steps_pre_active = orig_sk->gen_steps_pre_active;
+    bm->sk.gen_steps_post_active = orig_sk->gen_steps_post_active;
+    bm->orig_sk = orig_sk;
+    bed_mesh_note_callbacks(bm);
+    return 0;
+}
+
+int __visible
+bed_mesh_set_mesh(struct stepper_kinematics *sk, double *coeffs
+                  , int x_count, int y_count, double x_min, double y_min
+                  , double x_dist, double y_dist, double mesh_offset)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->coeffs);
+    bm->coeffs = NULL;
+    int ret = 0;
+    if (coeffs && x_count >= 2 && y_count >= 2) {
+        size_t size = sizeof(*coeffs) * 4 * (x_count - 1) * (y_count - 1);
+        bm->coeffs = malloc(size);
+        if (bm->coeffs)
+            memcpy(bm->coeffs, coeffs, size);
+        else
+            ret = -1;
+    }
+    bm->x_count = x_count;
+    bm->y_count = y_count;
+    bm->x_min = x_min;
+    bm->y_min = y_min;
+    bm->x_dist = x_dist;
+    bm->y_dist = y_dist;
+    bm->mesh_offset = mesh_offset;
+    bed_mesh_note_callbacks(bm);
+    return ret;
+}
+
+void __visible
+bed_mesh_set_fade(struct stepper_kinematics *sk, double fade_start
+                  , double fade_end, double fade_dist)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    bm->fade_start = fade_start;
+    bm->fade_end = fade_end;
+    bm->fade_dist = fade_dist;
+}
+
+struct stepper_kinematics * __visible
+bed_mesh_alloc(void)
+{
+    struct bed_mesh *bm = malloc(sizeof(*bm));
+    memset(bm, 0, sizeof(*bm));
+    bm->m.move_t = 2. * DUMMY_T;
+    bm->sk.calc_position_cb = bed_mesh_calc_position;
+    return &bm->sk;
+}
+
+void __visible
+bed_mesh_free(struct stepper_kinematics *sk)
+{
+    struct bed_mesh *bm = container_of(sk, struct bed_mesh, sk);
+    free(bm->coeffs);
+    free(bm);
+}
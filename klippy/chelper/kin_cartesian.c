@@ -32,6 +32,24 @@ cart_stepper_z_calc_position(struct stepper_kinematics *sk, struct move *m
     return move_get_coord(m, move_time).z;
 }
 
+static struct sk_poly
+cart_stepper_x_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 1., 0., 0.);
+}
+
+static struct sk_poly
+cart_stepper_y_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 0., 1., 0.);
+}
+
+static struct sk_poly
+cart_stepper_z_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 0., 0., 1.);
+}
+
 struct stepper_kinematics * __visible
 cartesian_stepper_alloc(char axis)
 {
@@ -39,12 +57,15 @@ cartesian_stepper_alloc(char axis)
     memset(sk, 0, sizeof(*sk));
     if (axis == 'x') {
         sk->calc_position_cb = cart_stepper_x_calc_position;
+        sk->calc_poly_cb = cart_stepper_x_calc_poly;
         sk->active_flags = AF_X;
     } else if (axis == 'y') {
         sk->calc_position_cb = cart_stepper_y_calc_position;
+        sk->calc_poly_cb = cart_stepper_y_calc_poly;
         sk->active_flags = AF_Y;
     } else if (axis == 'z') {
         sk->calc_position_cb = cart_stepper_z_calc_position;
+        sk->calc_poly_cb = cart_stepper_z_calc_poly;
         sk->active_flags = AF_Z;
     }
     return sk;
@@ -26,15 +26,30 @@ corexy_stepper_minus_calc_position(struct stepper_kinematics *sk, struct move *m
     return c.x - c.y;
 }
 
+static struct sk_poly
+corexy_stepper_plus_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 1., 1., 0.);
+}
+
+static struct sk_poly
+corexy_stepper_minus_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 1., -1., 0.);
+}
+
 struct stepper_kinematics * __visible
 corexy_stepper_alloc(char type)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (type == '+')
+    if (type == '+') {
         sk->calc_position_cb = corexy_stepper_plus_calc_position;
-    else if (type == '-')
+        sk->calc_poly_cb = corexy_stepper_plus_calc_poly;
+    } else if (type == '-') {
         sk->calc_position_cb = corexy_stepper_minus_calc_position;
+        sk->calc_poly_cb = corexy_stepper_minus_calc_poly;
+    }
     sk->active_flags = AF_X | AF_Y;
     return sk;
 }
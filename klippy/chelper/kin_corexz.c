@@ -26,15 +26,30 @@ corexz_stepper_minus_calc_position(struct stepper_kinematics *sk, struct move *m
     return c.x - c.z;
 }
 
+static struct sk_poly
+corexz_stepper_plus_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 1., 0., 1.);
+}
+
+static struct sk_poly
+corexz_stepper_minus_calc_poly(struct stepper_kinematics *sk, struct move *m)
+{
+    return itersolve_linear_poly(m, 1., 0., -1.);
+}
+
 struct stepper_kinematics * __visible
 corexz_stepper_alloc(char type)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (type == '+')
+    if (type == '+') {
         sk->calc_position_cb = corexz_stepper_plus_calc_position;
-    else if (type == '-')
+        sk->calc_poly_cb = corexz_stepper_plus_calc_poly;
+    } else if (type == '-') {
         sk->calc_position_cb = corexz_stepper_minus_calc_position;
+        sk->calc_poly_cb = corexz_stepper_minus_calc_poly;
+    }
     sk->active_flags = AF_X | AF_Z;
     return sk;
 }
@@ -375,6 +375,10 @@ struct serialqueue {
     struct list_head notify_queue;
     // Received messages
     struct list_head receive_queue;
+    // Buffered output (write only mode)
+    uint8_t *write_buf;
+    int write_buf_size, write_buf_len;
+    struct command_queue write_queue;
     // Debugging
     struct list_head old_sent, old_receive;
     // Stats
@@ -650,6 +654,39 @@ retransmit_event(struct serialqueue *sq, double eventtime)
     return waketime;
 }
 
+// Write any buffered output data to the serial port
+static void
+flush_write_buffer(struct serialqueue *sq)
+{
+    int pos = 0;
+    while (pos < sq->write_buf_len) {
+        int ret = write(sq->serial_fd, &sq->write_buf[pos]
+                        , sq->write_buf_len - pos);
+        if (ret < 0) {
+            report_errno("write", ret);
+            break;
+        }
+        pos += ret;
+    }
+    sq->write_buf_len = 0;
+}
+
+// Write a block of data to the serial port (or to the output buffer)
+static void
+do_write(struct serialqueue *sq, uint8_t *data, int len)
+{
+    if (!sq->write_buf) {
+        int ret = write(sq->serial_fd, data, len);
+        if (ret < 0)
+            report_errno("write", ret);
+        return;
+    }
+    if (sq->write_buf_len + len > sq->write_buf_size)
+        flush_write_buffer(sq);
+    memcpy(&sq->write_buf[sq->write_buf_len], data, len);
+    sq->write_buf_len += len;
+}
+
 // Construct a block of data and send to the serial port
 static void
 build_and_send_command(struct serialqueue *sq, double eventtime)
@@ -702,13 +739,17 @@ build_and_send_command(struct serialqueue *sq, double eventtime)
     out->msg[out->len - MESSAGE_TRAILER_SYNC] = MESSAGE_SYNC;
 
     // Send message
-    int ret = write(sq->serial_fd, out->msg, out->len);
-    if (ret < 0)
-        report_errno("write", ret);
+    do_write(sq, out->msg, out->len);
     sq->bytes_write += out->len;
     if (eventtime > sq->idle_time)
         sq->idle_time = eventtime;
     sq->idle_time += out->len * sq->baud_adjust;
+    if (sq->receive_seq == (uint64_t)-1) {
+        // Write only mode - no ack will arrive for this message
+        sq->send_seq++;
+        message_free(out);
+        return;
+    }
     out->sent_time = eventtime;
     out->receive_time = sq->idle_time;
     if (list_empty(&sq->sent_queue))
@@ -818,7 +859,13 @@ background_thread(void *data)
     struct serialqueue *sq = data;
     pollreactor_run(&sq->pr);
 
+    if (sq->write_buf)
+        // Send any messages still queued in buffered output mode
+        command_event(sq, get_monotonic());
+
     pthread_mutex_lock(&sq->lock);
+    if (sq->write_buf)
+        flush_write_buffer(sq);
     check_wake_receive(sq);
     pthread_mutex_unlock(&sq->lock);
 
@@ -922,6 +969,7 @@ serialqueue_free(struct serialqueue *sq)
     }
     pthread_mutex_unlock(&sq->lock);
     pollreactor_free(&sq->pr);
+    free(sq->write_buf);
     free(sq);
 }
 
@@ -969,12 +1017,16 @@ serialqueue_send_batch(struct serialqueue *sq, struct command_queue *cq
 
     // Add list to cq->stalled_queue
     pthread_mutex_lock(&sq->lock);
+    if (sq->write_buf)
+        // Buffered output - send messages in the order they are queued
+        cq = &sq->write_queue;
     if (list_empty(&cq->ready_queue) && list_empty(&cq->stalled_queue))
         list_add_tail(&cq->node, &sq->pending_queues);
     list_join_tail(msgs, &cq->stalled_queue);
     sq->stalled_bytes += len;
     int mustwake = 0;
-    if (qm->min_clock < sq->need_kick_clock) {
+    if (qm->min_clock < sq->need_kick_clock
+        && sq->stalled_bytes >= sq->write_buf_size / 2) {
         sq->need_kick_clock = 0;
         mustwake = 1;
     }
@@ -1059,6 +1111,24 @@ serialqueue_set_receive_window(struct serialqueue *sq, int receive_window)
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Buffer the outgoing data and only write it to the serial port in
+// large blocks (only valid in write only mode).  Pending messages are
+// only transmitted once enough data is queued to half fill the buffer,
+// and all messages are then sent in the order they were queued (as
+// otherwise messages queued together would be reordered by priority).
+void __visible
+serialqueue_set_write_buffer(struct serialqueue *sq, int size)
+{
+    pthread_mutex_lock(&sq->lock);
+    if (sq->receive_seq == (uint64_t)-1 && !sq->write_buf && size > 0) {
+        sq->write_buf = malloc(size);
+        sq->write_buf_size = size;
+        list_init(&sq->write_queue.ready_queue);
+        list_init(&sq->write_queue.stalled_queue);
+    }
+    pthread_mutex_unlock(&sq->lock);
+}
+
 // Set the estimated clock rate of the mcu on the other end of the
 // serial port
 void __visible
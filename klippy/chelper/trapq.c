@@ -68,6 +68,21 @@ trapq_append(struct trapq *tq, double print_time
     }
 }
 
+// Add a batch of moves (as filled from a single buffer) to the queue
+void __visible
+trapq_append_moves(struct trapq *tq, struct append_move *moves, int count)
+{
+    int i;
+    for (i=0; i<count; i++) {
+        struct append_move *am = &moves[i];
+        trapq_append(tq, am->print_time
+                     , am->accel_t, am->cruise_t, am->decel_t
+                     , am->start_pos_x, am->start_pos_y, am->start_pos_z
+                     , am->axes_r_x, am->axes_r_y, am->axes_r_z
+                     , am->start_v, am->cruise_v, am->accel);
+    }
+}
+
 // Return the distance moved given a time in a move
 inline double
 move_get_distance(struct move *m, double move_time)
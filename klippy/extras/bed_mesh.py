@@ -5,6 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, json, collections
+import chelper, toolhead
 from . import probe
 
 PROFILE_VERSION = 1
@@ -74,6 +75,22 @@ class BedMesh:
         self.fade_target = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
+        # Optional compensation in the z stepper kinematics
+        self.stepper_kinematics = []
+        self.orig_stepper_kinematics = []
+        self.kin_mesh_paused = False
+        self.kin_adj_range = (0., 0.)
+        self.kin_mesh_area = None
+        self.kin_checked_z = None
+        if self.splitter.split_mode == 'kinematic':
+            self.printer.register_event_handler("klippy:mcu_identify",
+                                                self.handle_mcu_identify)
+            self.printer.register_event_handler("stepper_enable:motor_off",
+                                                self.handle_motor_off)
+            self.printer.register_event_handler(
+                "homing:home_rails_begin", self.handle_homing_begin)
+            self.printer.register_event_handler(
+                "homing:homing_move_begin", self.handle_homing_begin)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
@@ -94,7 +111,92 @@ class BedMesh:
         self.toolhead = self.printer.lookup_object('toolhead')
         self.bmc.print_generated_points(logging.info)
         self.pmgr.initialize()
+    def handle_mcu_identify(self):
+        # Wrap the z steppers before other modules (eg, input_shaper)
+        # wrap the stepper kinematics during klippy:connect
+        kin = self.printer.lookup_object('toolhead').get_kinematics()
+        ffi_main, ffi_lib = chelper.get_ffi()
+        for s in kin.get_steppers():
+            sk = ffi_main.gc(ffi_lib.bed_mesh_alloc(), ffi_lib.bed_mesh_free)
+            orig_sk = s.set_stepper_kinematics(sk)
+            res = ffi_lib.bed_mesh_set_sk(sk, orig_sk)
+            if res < 0:
+                s.set_stepper_kinematics(orig_sk)
+                continue
+            self.stepper_kinematics.append(sk)
+            self.orig_stepper_kinematics.append(orig_sk)
+        if not self.stepper_kinematics:
+            raise self.printer.config_error(
+                "bed_mesh: No z steppers found for split_mode kinematic")
+    def handle_homing_begin(self, *args):
+        if self._is_kinematic_active():
+            # Homing and probing positions are reported from the
+            # steppers, so don't apply the mesh in the kinematics until
+            # the next gcode move (as with the other split modes, the
+            # toolhead position is then the actual nozzle position)
+            self._set_kinematic_paused(True)
+    def handle_motor_off(self, print_time):
+        # The kinematic limits are reset when the motors are disabled
+        self.kin_checked_z = None
+    def _set_kinematic_paused(self, paused):
+        kin_pos = self._note_kinematic_change()
+        self.kin_mesh_paused = paused
+        self._apply_kinematic_change(kin_pos)
+    def _is_kinematic_active(self):
+        return (self.stepper_kinematics and self.z_mesh is not None
+                and not self.kin_mesh_paused)
+    def _note_kinematic_change(self):
+        # Return the toolhead position with the mesh adjustment (if any)
+        # applied by the stepper kinematics prior to changing it
+        if not self.stepper_kinematics or self.toolhead is None:
+            return None
+        self.toolhead.flush_step_generation()
+        x, y, z, e = self.toolhead.get_position()
+        if self._is_kinematic_active():
+            z = self._calc_toolhead_z(x, y, z)
+        return [x, y, z, e]
+    def _apply_kinematic_change(self, kin_pos):
+        if kin_pos is None:
+            return
+        ffi_main, ffi_lib = chelper.get_ffi()
+        mesh = self.z_mesh
+        if self._is_kinematic_active() and mesh.mesh_coeffs is not None:
+            coeffs = ffi_main.new(
+                "double[]", [v for c in mesh.mesh_coeffs for v in c])
+            mesh_params = (coeffs, mesh.mesh_x_count, mesh.mesh_y_count,
+                           mesh.mesh_x_min, mesh.mesh_y_min,
+                           mesh.mesh_x_dist, mesh.mesh_y_dist,
+                           mesh.mesh_offset)
+            # Range of the adjustment (with fade) applied to z positions
+            min_z, max_z = mesh.get_z_range()
+            self.kin_adj_range = (min(0., min_z) + mesh.mesh_offset,
+                                  max(0., max_z) + mesh.mesh_offset)
+            params = mesh.get_mesh_params()
+            self.kin_mesh_area = (params['min_x'], params['min_y'],
+                                  params['max_x'], params['max_y'])
+        else:
+            mesh_params = (ffi_main.NULL, 0, 0, 0., 0., 1., 1., 0.)
+        for sk in self.stepper_kinematics:
+            if ffi_lib.bed_mesh_set_mesh(sk, *mesh_params) < 0:
+                raise self.gcode.error("bed_mesh: Unable to allocate mesh")
+            ffi_lib.bed_mesh_set_fade(sk, self.fade_start, self.fade_end,
+                                      self.fade_dist)
+        self.kin_checked_z = None
+        # Keep the nozzle in place when the adjustment changes
+        x, y, z, e = kin_pos
+        if self._is_kinematic_active():
+            z = self._calc_gcode_z(x, y, z)
+        self.toolhead.set_position([x, y, z, e])
     def set_mesh(self, mesh):
+        kin_pos = self._note_kinematic_change()
+        try:
+            self._set_mesh(mesh)
+        finally:
+            self._apply_kinematic_change(kin_pos)
+        # cache the current position before a transform takes place
+        gcode_move = self.printer.lookup_object('gcode_move')
+        gcode_move.reset_last_position()
+    def _set_mesh(self, mesh):
         if mesh is not None and self.fade_end != self.FADE_DISABLE:
             self.log_fade_complete = True
             if self.base_fade_target is None:
@@ -127,9 +229,6 @@ class BedMesh:
             self.fade_target = 0.
         self.z_mesh = mesh
         self.splitter.initialize(mesh)
-        # cache the current position before a transform takes place
-        gcode_move = self.printer.lookup_object('gcode_move')
-        gcode_move.reset_last_position()
     def get_z_factor(self, z_pos):
         if z_pos >= self.fade_end:
             return 0.
@@ -137,34 +236,105 @@ class BedMesh:
             return (self.fade_end - z_pos) / self.fade_dist
         else:
             return 1.
+    def _calc_toolhead_z(self, x, y, z):
+        # Return the toolhead z height for a gcode z position
+        if self.z_mesh is None:
+            return z + self.fade_target
+        z_adj = self.get_z_factor(z) * self.z_mesh.calc_z(x, y)
+        return z + z_adj + self.z_mesh.mesh_offset
+    def _calc_gcode_z(self, x, y, z):
+        # Return the gcode z position for a toolhead z height
+        if self.z_mesh is None:
+            return z - self.fade_target
+        z_adj = self.z_mesh.calc_z(x, y)
+        factor = 1.
+        max_adj = z_adj + self.fade_target
+        if min(z, (z - max_adj)) >= self.fade_end:
+            # Fade out is complete, no factor
+            factor = 0.
+        elif max(z, (z - max_adj)) >= self.fade_start:
+            # Likely in the process of fading out adjustment.
+            # Because we don't yet know the gcode z position, use
+            # algebra to calculate the factor from the toolhead pos
+            factor = ((self.fade_end + self.fade_target - z) /
+                      (self.fade_dist - z_adj))
+            factor = constrain(factor, 0., 1.)
+        final_z_adj = factor * z_adj + self.fade_target
+        return z - final_z_adj
     def get_position(self):
         # Return last, non-transformed position
-        if self.z_mesh is None:
-            # No mesh calibrated, so send toolhead position
-            self.last_position[:] = self.toolhead.get_position()
-            self.last_position[2] -= self.fade_target
-        else:
-            # return current position minus the current z-adjustment
-            x, y, z, e = self.toolhead.get_position()
-            z_adj = self.z_mesh.calc_z(x, y)
-            factor = 1.
-            max_adj = z_adj + self.fade_target
-            if min(z, (z - max_adj)) >= self.fade_end:
-                # Fade out is complete, no factor
-                factor = 0.
-            elif max(z, (z - max_adj)) >= self.fade_start:
-                # Likely in the process of fading out adjustment.
-                # Because we don't yet know the gcode z position, use
-                # algebra to calculate the factor from the toolhead pos
-                factor = ((self.fade_end + self.fade_target - z) /
-                          (self.fade_dist - z_adj))
-                factor = constrain(factor, 0., 1.)
-            final_z_adj = factor * z_adj + self.fade_target
-            self.last_position[:] = [x, y, z - final_z_adj, e]
+        x, y, z, e = self.toolhead.get_position()
+        if not self._is_kinematic_active():
+            # Return current position minus the current z-adjustment
+            z = self._calc_gcode_z(x, y, z)
+        self.last_position[:] = [x, y, z, e]
         return list(self.last_position)
+    def _check_kinematic_pos(self, pos, speed):
+        # Check the position with a z only move to it
+        start_pos = list(pos)
+        start_pos[2] += 1.
+        move = toolhead.Move(self.toolhead, start_pos, pos, speed)
+        self.toolhead.get_kinematics().check_move(move)
+    def _check_kinematic_area(self, low_z, high_z, speed):
+        # Check the corners of the mesh area at the lowest and highest
+        # adjusted z heights
+        min_x, min_y, max_x, max_y = self.kin_mesh_area
+        e = self.last_position[3]
+        try:
+            for z in [low_z, high_z]:
+                for x, y in [(min_x, min_y), (min_x, max_y),
+                             (max_x, min_y), (max_x, max_y)]:
+                    self._check_kinematic_pos([x, y, z, e], speed)
+        except self.printer.command_error:
+            return False
+        return True
+    def _check_kinematic_move(self, newpos, speed):
+        # The toolhead only checks the position without the mesh
+        # adjustment.  Moves within the mesh area only need further
+        # checks if the adjusted z may leave the z range already checked
+        # over the whole mesh area.
+        last_pos = self.last_position
+        adj_min, adj_max = self.kin_adj_range
+        low_z = min(last_pos[2], newpos[2]) + adj_min
+        high_z = max(last_pos[2], newpos[2]) + adj_max
+        min_x, min_y, max_x, max_y = self.kin_mesh_area
+        if (min_x <= last_pos[0] <= max_x and min_x <= newpos[0] <= max_x
+            and min_y <= last_pos[1] <= max_y
+            and min_y <= newpos[1] <= max_y):
+            checked_z = self.kin_checked_z
+            if checked_z is not None:
+                if checked_z[0] <= low_z and high_z <= checked_z[1]:
+                    return
+                low_z = min(low_z, checked_z[0])
+                high_z = max(high_z, checked_z[1])
+            if self._check_kinematic_area(low_z, high_z, speed):
+                self.kin_checked_z = (low_z, high_z)
+                return
+        # Check the lowest and highest adjusted position along the move
+        # (the mesh z is checked at each grid crossing)
+        ts, mesh_zs = self.splitter.calc_move_mesh_z(last_pos, newpos)
+        mesh_offset = self.z_mesh.mesh_offset
+        low = high = None
+        for t, mesh_z in zip(ts[1:], mesh_zs[1:]):
+            pos = [lerp(t, p0, p1) for p0, p1 in zip(last_pos, newpos)]
+            pos[2] += self.get_z_factor(pos[2]) * mesh_z + mesh_offset
+            if low is None or pos[2] < low[2]:
+                low = pos
+            if high is None or pos[2] > high[2]:
+                high = pos
+        for pos in [low, high]:
+            self._check_kinematic_pos(pos, speed)
     def move(self, newpos, speed):
         factor = self.get_z_factor(newpos[2])
-        if self.z_mesh is None or not factor:
+        is_resume = self.kin_mesh_paused
+        if is_resume:
+            # Resume the kinematic mesh after homing or probing
+            self._set_kinematic_paused(False)
+        if self._is_kinematic_active():
+            # The mesh is applied by the z stepper kinematics
+            self._check_kinematic_move(newpos, speed)
+            self.toolhead.move(newpos, speed)
+        elif self.z_mesh is None or not factor:
             # No mesh calibrated, or mesh leveling phased out.
             x, y, z, e = newpos
             if self.log_fade_complete:
@@ -183,6 +353,10 @@ class BedMesh:
                     raise self.gcode.error(
                         "Mesh Leveling: Error splitting move ")
         self.last_position[:] = newpos
+        if is_resume:
+            # Resuming resets the gcode position - update it to newpos
+            gcode_move = self.printer.lookup_object('gcode_move')
+            gcode_move.reset_last_position()
     def get_status(self, eventtime=None):
         status = {
             "profile_name": "",
@@ -542,6 +716,11 @@ class MoveSplitter:
             'split_delta_z', .025, minval=0.01)
         self.move_check_distance = config.getfloat(
             'move_check_distance', 5., minval=3.)
+        split_modes = {'distance': 'distance', 'grid': 'grid',
+                       'kinematic': 'kinematic'}
+        self.split_mode = config.getchoice('split_mode', split_modes,
+                                           'distance')
+        self.grid_splits = []
         self.z_mesh = None
         self.gcode = gcode
     def initialize(self, mesh):
@@ -557,6 +736,16 @@ class MoveSplitter:
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self.grid_splits = []
+        if self.split_mode == 'grid' and (self.axis_move[0]
+                                          or self.axis_move[1]):
+            self._build_grid_splits()
+    def calc_move_mesh_z(self, prev_pos, next_pos):
+        # Return the mesh z at the start, end, and each grid crossing
+        # of a move
+        self.build_move(prev_pos, next_pos, 1.)
+        ts = self._get_grid_crossings()
+        return ts, self._calc_move_z(ts)
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         return self.z_factor * z + self.z_mesh.mesh_offset
@@ -566,13 +755,98 @@ class MoveSplitter:
             raise self.gcode.error(
                 "bed_mesh: Slice distance is negative "
                 "or greater than entire move length")
+        self._set_move_position(t)
+    def _set_move_position(self, t):
         for i in range(4):
             if self.axis_move[i]:
                 self.current_pos[i] = lerp(
                     t, self.prev_pos[i], self.next_pos[i])
+    def _calc_move_z(self, ts):
+        # Mesh z (without fade or offset) at positions along the move
+        x0, y0 = self.prev_pos[:2]
+        x1, y1 = self.next_pos[:2]
+        return self.z_mesh.calc_z_many([lerp(t, x0, x1) for t in ts],
+                                       [lerp(t, y0, y1) for t in ts])
+    def _get_grid_crossings(self):
+        # Find where the move crosses the mesh grid lines.  The mesh is
+        # bilinear within each grid cell (and constant along an axis
+        # outside of the mesh), so its slope can only change there.
+        zm = self.z_mesh
+        crossings = [0., 1.]
+        for axis, mesh_min, dist, count in [
+                (0, zm.mesh_x_min, zm.mesh_x_dist, zm.mesh_x_count),
+                (1, zm.mesh_y_min, zm.mesh_y_dist, zm.mesh_y_count)]:
+            if not self.axis_move[axis]:
+                continue
+            start = self.prev_pos[axis]
+            delta = self.next_pos[axis] - start
+            idx0 = (start - mesh_min) / dist
+            idx1 = (start + delta - mesh_min) / dist
+            lo = max(int(math.floor(min(idx0, idx1))) + 1, 0)
+            hi = min(int(math.ceil(max(idx0, idx1))) - 1, count - 1)
+            for i in range(lo, hi + 1):
+                crossings.append((mesh_min + i * dist - start) / delta)
+        crossings.sort()
+        # Merge crossings at grid corners
+        out = [0.]
+        for t in crossings[1:]:
+            if t - out[-1] > 1e-9:
+                out.append(t)
+        out[-1] = 1.
+        return out
+    def _build_grid_splits(self):
+        # Split the move at each grid crossing where the slope of the
+        # mesh along the move changes.  A diagonal move through a grid
+        # cell follows a quadratic curve - it is further divided so that
+        # it deviates from that curve by less than split_delta_z.
+        crossings = self._get_grid_crossings()
+        count = len(crossings) - 1
+        zs = self._calc_move_z(crossings)
+        if self.axis_move[0] and self.axis_move[1]:
+            mid_zs = self._calc_move_z([(crossings[i] + crossings[i+1]) * .5
+                                        for i in range(count)])
+        else:
+            # Mesh is linear within a cell along an axis aligned move
+            mid_zs = [(zs[i] + zs[i+1]) * .5 for i in range(count)]
+        segments = []
+        for i in range(count):
+            t0, t1, z0, z1 = crossings[i], crossings[i+1], zs[i], zs[i+1]
+            zmid = mid_zs[i]
+            # z(u) = z0 + b*u + c*u**2 for u from 0 to 1 over the segment
+            b = 4. * zmid - 3. * z0 - z1
+            c = 2. * (z0 + z1) - 4. * zmid
+            segments.append((t0, t1, z0, b, c))
+        splits = []
+        for i, (t0, t1, z0, b, c) in enumerate(segments):
+            if i:
+                pt0, pt1, pz0, pb, pc = segments[i-1]
+                end_slope = (pb + 2. * pc) / (pt1 - pt0)
+                start_slope = b / (t1 - t0)
+                if (not isclose(end_slope, start_slope, abs_tol=1e-6)
+                    or not isclose(c, 0., abs_tol=1e-9)
+                    or not isclose(pc, 0., abs_tol=1e-9)):
+                    splits.append((t0, z0))
+            deviation = abs(c) * .25 * self.z_factor
+            if deviation >= self.split_delta_z:
+                count = int(math.ceil(math.sqrt(
+                    deviation / self.split_delta_z)))
+                for j in range(1, count):
+                    u = float(j) / count
+                    splits.append((lerp(u, t0, t1), z0 + (b + c * u) * u))
+        splits.reverse()
+        self.grid_splits = splits
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
+            if self.grid_splits:
+                # Next grid split point
+                t, z = self.grid_splits.pop()
+                self._set_move_position(t)
+                self.z_offset = self.z_factor * z + self.z_mesh.mesh_offset
+                return self.current_pos[0], self.current_pos[1], \
+                    self.current_pos[2] + self.z_offset, \
+                    self.current_pos[3]
+            if self.split_mode == 'distance' and (self.axis_move[0]
+                                                  or self.axis_move[1]):
                 # X and/or Y axis move, traverse if necessary
                 while self.distance_checked + self.move_check_distance \
                         < self.total_move_length:
@@ -600,6 +874,7 @@ class MoveSplitter:
 class ZMesh:
     def __init__(self, params):
         self.probed_matrix = self.mesh_matrix = None
+        self.mesh_coeffs = None
         self.mesh_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
@@ -686,6 +961,7 @@ class ZMesh:
         # should produce an offset that is divisible by common
         # z step distances
         self.avg_z = round(self.avg_z, 2)
+        self._build_coeffs()
         self.print_mesh(logging.debug)
     def offset_mesh(self, offset):
         if self.mesh_matrix:
@@ -693,21 +969,42 @@ class ZMesh:
             for y_line in self.mesh_matrix:
                 for idx, z in enumerate(y_line):
                     y_line[idx] = z - self.mesh_offset
+            self._build_coeffs()
+    def _build_coeffs(self):
+        # Store the bilinear coefficients (a, b, c, d) of each grid cell
+        # so that z = a + b*tx + c*ty + d*tx*ty (where tx and ty are the
+        # position within the cell from 0 to 1)
+        tbl = self.mesh_matrix
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            line0, line1 = tbl[yidx], tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00, z10 = line0[xidx], line0[xidx+1]
+                z01, z11 = line1[xidx], line1[xidx+1]
+                coeffs.append((z00, z10 - z00, z01 - z00,
+                               z00 - z10 - z01 + z11))
+        self.mesh_coeffs = coeffs
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x, 0)
-            ty, yidx = self._get_linear_index(y, 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        if self.mesh_coeffs is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        # Positions outside the mesh use the nearest edge of the mesh
+        fx = (x - self.mesh_x_min) / self.mesh_x_dist
+        fy = (y - self.mesh_y_min) / self.mesh_y_dist
+        xidx = min(max(int(fx), 0), self.mesh_x_count - 2)
+        yidx = min(max(int(fy), 0), self.mesh_y_count - 2)
+        tx = min(max(fx - xidx, 0.), 1.)
+        ty = min(max(fy - yidx, 0.), 1.)
+        a, b, c, d = self.mesh_coeffs[yidx * (self.mesh_x_count - 1) + xidx]
+        return a + b * tx + (c + d * tx) * ty
+    def calc_z_many(self, xs, ys):
+        # Return the mesh z at each of a list of x, y positions
+        calc_z = self.calc_z
+        return [calc_z(x, y) for x, y in zip(xs, ys)]
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -715,24 +1012,6 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
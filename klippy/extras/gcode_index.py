@@ -0,0 +1,251 @@
+# Index of the layer changes in a g-code file
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import os, struct, bisect, logging, gzip
+import chelper
+
+INDEX_MAGIC = "KLIDX002"
+HEADER_FORMAT = "<8sQdI"
+CHECKPOINT_FORMAT = "<Q9dB"
+FLAG_ABSOLUTE_COORD = 1
+FLAG_ABSOLUTE_EXTRUDE = 2
+READ_SIZE = 64 * 1024
+DEFAULT_SPEED = 25. * 60.
+
+# The g-code state just before the first line of a layer
+class Checkpoint:
+    def __init__(self, offset, layer_z, position, base_position, speed,
+                 absolute_coord, absolute_extrude):
+        self.offset = offset
+        self.layer_z = layer_z
+        self.position = position
+        self.base_position = base_position
+        self.speed = speed
+        self.absolute_coord = absolute_coord
+        self.absolute_extrude = absolute_extrude
+    def get_restore_script(self):
+        # Return g-code that moves the toolhead to the position of this
+        # checkpoint (from a homed printer without g-code offsets) and
+        # restores the g-code move state
+        x, y, z = [p + b for p, b in zip(self.position, self.base_position)]
+        # Travel above the layer so the nozzle clears the printed part
+        safe_z = max(self.position[2], self.layer_z) + self.base_position[2]
+        out = ["G90",
+               "G1 Z%.6f" % (safe_z,),
+               "G1 X%.6f Y%.6f" % (x, y),
+               "G1 Z%.6f" % (z,),
+               "G92 X%.6f Y%.6f Z%.6f E%.6f" % tuple(self.position)]
+        if not self.absolute_coord:
+            out.append("G91")
+        out.append("M82" if self.absolute_extrude else "M83")
+        out.append("G1 F%.3f" % (self.speed,))
+        return "\n".join(out)
+
+class GCodeIndex:
+    def __init__(self, checkpoints):
+        self.checkpoints = checkpoints
+        self.heights = [cp.layer_z for cp in checkpoints]
+    def get_layer_count(self):
+        return len(self.checkpoints)
+    def lookup_layer(self, layer):
+        if layer >= len(self.checkpoints):
+            return None
+        return self.checkpoints[layer]
+    def lookup_height(self, z):
+        # Find the first layer printed at or above the given height
+        pos = bisect.bisect_left(self.heights, z - .000001)
+        if pos >= len(self.checkpoints):
+            return None
+        return self.checkpoints[pos]
+
+
+######################################################################
+# Index building
+######################################################################
+
+# Track the g-code move state and note the start of each layer
+class IndexBuilder:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.base_position = [0., 0., 0.]
+        self.speed = DEFAULT_SPEED
+        self.absolute_coord = self.absolute_extrude = True
+        self.last_layer_z = None
+        self.pending = None
+        self.checkpoints = []
+    def _checkpoint(self, offset, layer_z):
+        return Checkpoint(offset, layer_z, list(self.position),
+                          list(self.base_position), self.speed,
+                          self.absolute_coord, self.absolute_extrude)
+    def process_move(self, offset, params):
+        pos = self.position
+        newpos = list(pos)
+        for i, axis in enumerate('XYZ'):
+            if axis in params:
+                if self.absolute_coord:
+                    newpos[i] = params[axis]
+                else:
+                    newpos[i] += params[axis]
+        if 'E' in params:
+            if self.absolute_coord and self.absolute_extrude:
+                newpos[3] = params['E']
+            else:
+                newpos[3] += params['E']
+        # A layer starts at the first z change after an extrusion
+        if newpos[2] != pos[2] and self.pending is None:
+            self.pending = self._checkpoint(offset, None)
+        if newpos[3] > pos[3] and ('X' in params or 'Y' in params):
+            if (self.last_layer_z is None
+                or newpos[2] > self.last_layer_z + .000001):
+                cp = self.pending
+                if cp is None:
+                    cp = self._checkpoint(offset, None)
+                cp.layer_z = newpos[2]
+                self.checkpoints.append(cp)
+                self.last_layer_z = newpos[2]
+            self.pending = None
+        if 'F' in params:
+            self.speed = params['F']
+        self.position = newpos
+    def process_command(self, offset, cmd, params):
+        if cmd in ('G0', 'G1'):
+            self.process_move(offset, params)
+        elif cmd == 'G90':
+            self.absolute_coord = True
+        elif cmd == 'G91':
+            self.absolute_coord = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+        elif cmd == 'G92':
+            if not params:
+                params = {'X': 0., 'Y': 0., 'Z': 0., 'E': 0.}
+            for i, axis in enumerate('XYZE'):
+                if axis in params:
+                    if i < 3:
+                        # Note the offset from the machine position
+                        self.base_position[i] += (self.position[i]
+                                                  - params[axis])
+                    self.position[i] = params[axis]
+        elif cmd == 'G28':
+            axes = [a for a in 'XYZ' if a in params] or 'XYZ'
+            for axis in axes:
+                i = 'XYZ'.index(axis)
+                self.position[i] = self.base_position[i] = 0.
+
+def build_index(filename):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    tokens_size = 1024
+    tokens = ffi_main.new('struct gcode_line[]', tokens_size)
+    builder = IndexBuilder()
+    raw_f = open(filename, 'rb')
+    is_gzip = raw_f.read(2) == '\x1f\x8b'
+    raw_f.seek(0)
+    f = raw_f
+    if is_gzip:
+        # Offsets in compressed files are uncompressed byte positions
+        f = gzip.GzipFile(fileobj=raw_f, mode='rb')
+    try:
+        block_pos = 0
+        partial_input = ""
+        while 1:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            data = partial_input + data
+            end = data.rfind('\n') + 1
+            partial_input = data[end:]
+            count = data.count('\n', 0, end)
+            if count > tokens_size:
+                tokens_size = count
+                tokens = ffi_main.new('struct gcode_line[]', tokens_size)
+            num = ffi_lib.gcode_tokenize(tokens, count, data, end)
+            for i in range(num):
+                t = tokens[i]
+                letters = ffi_main.string(t.param_letters)
+                params = dict(zip(letters, t.param_values))
+                builder.process_command(block_pos + t.offset,
+                                        '%s%d' % (t.cmd, t.cmd_num), params)
+            block_pos += end
+    finally:
+        f.close()
+        raw_f.close()
+    return GCodeIndex(builder.checkpoints)
+
+
+######################################################################
+# Index files
+######################################################################
+
+# The index is stored in a hidden file next to the g-code file
+def get_index_filename(filename):
+    dname, fname = os.path.split(filename)
+    return os.path.join(dname, "." + fname + ".index")
+
+def _get_file_info(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+def load_index(filename):
+    # Returns None if there is no index (or it is out of date)
+    try:
+        f = open(get_index_filename(filename), 'rb')
+    except IOError:
+        return None
+    try:
+        header_size = struct.calcsize(HEADER_FORMAT)
+        magic, size, mtime, count = struct.unpack(
+            HEADER_FORMAT, f.read(header_size))
+        if magic != INDEX_MAGIC or (size, mtime) != _get_file_info(filename):
+            return None
+        cp_size = struct.calcsize(CHECKPOINT_FORMAT)
+        data = f.read(count * cp_size)
+        if len(data) != count * cp_size:
+            return None
+    except struct.error:
+        return None
+    finally:
+        f.close()
+    checkpoints = []
+    for pos in range(0, len(data), cp_size):
+        (offset, layer_z, x, y, z, e, base_x, base_y, base_z,
+         speed, flags) = struct.unpack_from(CHECKPOINT_FORMAT, data, pos)
+        checkpoints.append(Checkpoint(
+            offset, layer_z, [x, y, z, e], [base_x, base_y, base_z], speed,
+            not not flags & FLAG_ABSOLUTE_COORD,
+            not not flags & FLAG_ABSOLUTE_EXTRUDE))
+    return GCodeIndex(checkpoints)
+
+def save_index(filename, index, file_info):
+    out = [struct.pack(HEADER_FORMAT, INDEX_MAGIC, file_info[0],
+                       file_info[1], len(index.checkpoints))]
+    for cp in index.checkpoints:
+        flags = ((cp.absolute_coord and FLAG_ABSOLUTE_COORD)
+                 | (cp.absolute_extrude and FLAG_ABSOLUTE_EXTRUDE))
+        out.append(struct.pack(CHECKPOINT_FORMAT, cp.offset, cp.layer_z,
+                               *(cp.position + cp.base_position
+                                 + [cp.speed, flags])))
+    index_filename = get_index_filename(filename)
+    temp_filename = index_filename + ".tmp"
+    f = open(temp_filename, 'wb')
+    try:
+        f.write("".join(out))
+    finally:
+        f.close()
+    os.rename(temp_filename, index_filename)
+
+def get_index(filename):
+    # Load the index for a g-code file (building it if needed)
+    index = load_index(filename)
+    if index is not None:
+        return index
+    file_info = _get_file_info(filename)
+    index = build_index(filename)
+    try:
+        save_index(filename, index, file_info)
+    except EnvironmentError:
+        logging.exception("Unable to save g-code index")
+    return index
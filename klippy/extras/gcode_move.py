@@ -32,6 +32,8 @@ class GCodeMove:
             desc = getattr(self, 'cmd_' + cmd + '_help', None)
             gcode.register_command(cmd, func, False, desc)
         gcode.register_command('G0', self.cmd_G1)
+        gcode.register_move_handler('G0', self.cmd_G1, self.move_G1)
+        gcode.register_move_handler('G1', self.cmd_G1, self.move_G1)
         gcode.register_command('M114', self.cmd_M114, True)
         gcode.register_command('GET_POSITION', self.cmd_GET_POSITION, True)
         # G-Code coordinate manipulation
@@ -106,33 +108,38 @@ class GCodeMove:
         # Move
         params = gcmd.get_command_parameters()
         try:
-            for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise gcmd.error("Invalid speed in '%s'"
-                                     % (gcmd.get_commandline(),))
-                self.speed = gcode_speed * self.speed_factor
+            params = {axis: float(params[axis])
+                      for axis in 'XYZEF' if axis in params}
         except ValueError as e:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
-        self.move_with_transform(self.last_position, self.speed)
+        if params.get('F', 1.) <= 0.:
+            raise gcmd.error("Invalid speed in '%s'"
+                             % (gcmd.get_commandline(),))
+        self.move_G1(params)
+    def move_G1(self, params):
+        # Move with already parsed (and validated) parameters
+        last_position = self.last_position
+        for pos, axis in enumerate('XYZ'):
+            if axis in params:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    last_position[pos] += params[axis]
+                else:
+                    # value relative to base coordinate position
+                    last_position[pos] = (params[axis]
+                                          + self.base_position[pos])
+        if 'E' in params:
+            v = params['E'] * self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                last_position[3] = v + self.base_position[3]
+        if 'F' in params:
+            self.speed = params['F'] * self.speed_factor
+        self.move_with_transform(last_position, self.speed)
     def cmd_G28(self, gcmd):
         # Move to origin
         axes = []
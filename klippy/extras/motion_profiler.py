@@ -0,0 +1,120 @@
+# Timing of the host motion pipeline stages
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import chelper
+
+# Each stage reports its "self" time - the time spent in that stage
+# excluding any time spent in other (nested) stages.  The itersolve
+# stage is the time spent generating step times in the C code (which
+# is nested in step_generation).  If step_generation_threads is in use
+# then step_generation covers each parallel step generation pass and
+# itersolve is the time summed over all the threads.
+STAGES = ["gcode", "lookahead", "process_moves", "trapq_append",
+          "step_generation", "itersolve", "mcu_flush"]
+
+class ProfileStage:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_time = self.self_time = self.max_time = 0.
+    def get_status(self):
+        return {'count': self.count, 'total_time': self.total_time,
+                'self_time': self.self_time, 'max_time': self.max_time}
+
+class MotionProfiler:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.monotonic = self.printer.get_reactor().monotonic
+        self.stages = {name: ProfileStage(name) for name in STAGES}
+        self.stack = []
+        self.slowest = (None, 0.)
+        ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.itersolve_profile = ffi_main.new('struct itersolve_profile *')
+        self.printer.register_event_handler("klippy:connect",
+                                            self.handle_connect)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("motion_profiler/status",
+                                   self._handle_web_request)
+    def handle_connect(self):
+        gcode = self.printer.lookup_object('gcode')
+        self._wrap(gcode, '_process_commands', "gcode")
+        toolhead = self.printer.lookup_object('toolhead')
+        self._wrap(toolhead.move_queue, 'flush', "lookahead")
+        self._wrap(toolhead, '_process_moves', "process_moves")
+        self._wrap(toolhead, 'trapq_append_moves', "trapq_append")
+        if toolhead.step_pool is not None:
+            # Time each pass of the step generation worker threads
+            self._wrap(toolhead, '_generate_steps_parallel',
+                       "step_generation", self._get_itersolve_time)
+        else:
+            stage = self.stages["step_generation"]
+            toolhead.step_generators = [
+                self._wrap_func(sg, stage, self._get_itersolve_time)
+                for sg in toolhead.step_generators]
+        for m in toolhead.all_mcus:
+            self._wrap(m, 'flush_moves', "mcu_flush")
+        self.ffi_lib.itersolve_set_profiling(1)
+    def _wrap(self, obj, attr, name, get_c_time=None):
+        setattr(obj, attr, self._wrap_func(getattr(obj, attr),
+                                           self.stages[name], get_c_time))
+    def _wrap_func(self, func, stage, get_c_time=None):
+        # The optional get_c_time() reports the cumulative time of a
+        # nested stage that is timed in the C code
+        monotonic = self.monotonic
+        stack = self.stack
+        def timed_func(*args, **kwargs):
+            start_time = monotonic()
+            if get_c_time is not None:
+                start_c_time = get_c_time()
+            stack.append(0.)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                run_time = monotonic() - start_time
+                nested_time = stack.pop()
+                if get_c_time is not None:
+                    nested_time += get_c_time() - start_c_time
+                if stack:
+                    stack[-1] += run_time
+                stage.count += 1
+                stage.total_time += run_time
+                stage.self_time += run_time - nested_time
+                if run_time > stage.max_time:
+                    stage.max_time = run_time
+                if run_time > self.slowest[1]:
+                    self.slowest = (stage.name, run_time)
+        return timed_func
+    def _get_itersolve_time(self):
+        # Time the calling thread spent in the C step generation code
+        p = self.itersolve_profile
+        self.ffi_lib.itersolve_get_profile(p)
+        return p.wall_time
+    def _update_itersolve(self):
+        p = self.itersolve_profile
+        self.ffi_lib.itersolve_get_profile(p)
+        stage = self.stages["itersolve"]
+        stage.count = p.count
+        stage.total_time = stage.self_time = p.time
+        stage.max_time = p.max_time
+    def get_status(self, eventtime):
+        self._update_itersolve()
+        return {name: s.get_status() for name, s in self.stages.items()}
+    def _handle_web_request(self, web_request):
+        eventtime = self.printer.get_reactor().monotonic()
+        web_request.send(self.get_status(eventtime))
+    def stats(self, eventtime):
+        self._update_itersolve()
+        msg = ' '.join(["%s=%.3f/%d" % (name, self.stages[name].self_time,
+                                        self.stages[name].count)
+                        for name in STAGES])
+        # Report the longest single call since the last stats report
+        name, run_time = self.slowest
+        self.slowest = (None, 0.)
+        if name is not None:
+            msg += " slowest=%s:%.3f" % (name, run_time)
+        return False, "motion_profiler: " + msg
+
+def load_config(config):
+    return MotionProfiler(config)
@@ -3,10 +3,305 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, logging, threading, collections, bisect, zlib
+import binary_gcode
+from . import gcode_index
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+def is_gcode_file(name):
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return name[name.rfind('.')+1:] in VALID_GCODE_EXTS
+
+# Cached list of the g-code files in a directory tree.  A directory
+# is only rescanned when its modification time changes.
+class FileListCache:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.dirs = {}
+        self.file_list = []
+        self.files_by_lower = {}
+    def _scan_dir(self, path, old_entry):
+        # Returns the files and subdirectories of a directory (only new
+        # names are checked - known names keep their old type)
+        known = {}
+        if old_entry is not None:
+            known.update((os.path.basename(f), f) for f in old_entry[1])
+            known.update((os.path.basename(d), None) for d in old_entry[2])
+        files = []
+        subdirs = []
+        try:
+            names = os.listdir(path)
+        except os.error:
+            return files, subdirs
+        for name in names:
+            full_path = os.path.join(path, name)
+            if name in known:
+                if known[name] is None:
+                    subdirs.append(full_path)
+                else:
+                    files.append(known[name])
+                continue
+            try:
+                if os.path.isdir(full_path):
+                    subdirs.append(full_path)
+                elif is_gcode_file(name):
+                    files.append(full_path[len(self.dirname) + 1:])
+            except os.error:
+                continue
+        return files, subdirs
+    def update(self):
+        old_dirs = self.dirs
+        new_dirs = {}
+        is_changed = False
+        pending = [self.dirname]
+        seen = set()
+        while pending:
+            path = pending.pop()
+            try:
+                st = os.stat(path)
+            except os.error:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                # Don't follow symlink loops
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            entry = old_dirs.get(path)
+            if entry is None or entry[0] != st.st_mtime:
+                entry = (st.st_mtime,) + self._scan_dir(path, entry)
+                is_changed = True
+            new_dirs[path] = entry
+            pending.extend(entry[2])
+        if is_changed or len(new_dirs) != len(old_dirs):
+            flist = [f for entry in new_dirs.values() for f in entry[1]]
+            self.file_list = sorted(flist, key=lambda f: f.lower())
+            self.files_by_lower = { fname.lower(): fname
+                                    for fname in self.file_list }
+        self.dirs = new_dirs
+    def get_file_list(self):
+        self.update()
+        # File sizes may change without a directory change, so only
+        # the sizes are looked up on each request
+        flist = []
+        for fname in self.file_list:
+            try:
+                fsize = os.path.getsize(os.path.join(self.dirname, fname))
+            except os.error:
+                continue
+            flist.append((fname, fsize))
+        return flist
+    def lookup(self, filename):
+        # Find a file by its case insensitive name
+        self.update()
+        return self.files_by_lower.get(filename.lower())
+
+READ_SIZE = 8192
+
+# Read blocks of complete lines from a g-code file
+class FileReader:
+    def __init__(self, f, position):
+        self.f = f
+        self.partial_input = ""
+        f.seek(position)
+    def read_block(self):
+        # Returns the next block of complete lines (or "" at end of file)
+        while 1:
+            data = self.f.read(READ_SIZE)
+            if not data:
+                return ""
+            pos = data.rfind('\n') + 1
+            if not pos:
+                self.partial_input += data
+                continue
+            block = self.partial_input + data[:pos]
+            self.partial_input = data[pos:]
+            return block
+    def close(self):
+        pass
+
+# Read blocks of records from a binary g-code file
+class BinaryReader:
+    def __init__(self, f, position):
+        self.f = f
+        f.seek(position)
+    def read_block(self):
+        # Blocks may end mid-record (the caller keeps any partial record)
+        return self.f.read(READ_SIZE)
+    def close(self):
+        pass
+
+GZIP_CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+
+# Saved decompressor states of a gzip file (to allow seeking)
+class GzipCheckpoints:
+    def __init__(self):
+        self.positions = [0]
+        self.checkpoints = [(0, 0, zlib.decompressobj(16 + zlib.MAX_WBITS))]
+        self.last_position = self.last_compressed_position = 0
+    def note_position(self, position, compressed_position, decompressor):
+        if position > self.last_position:
+            self.last_position = position
+            self.last_compressed_position = compressed_position
+        if position >= self.positions[-1] + GZIP_CHECKPOINT_INTERVAL:
+            self.checkpoints.append(
+                (position, compressed_position, decompressor.copy()))
+            self.positions.append(position)
+    def lookup(self, position):
+        # Return the last checkpoint at or before the given position
+        i = bisect.bisect_right(self.positions, position) - 1
+        return self.checkpoints[i]
+    def get_compressed_position(self, position):
+        # Estimate the compressed bytes needed to reach a position
+        i = bisect.bisect_right(self.positions, position) - 1
+        pos, cpos, d = self.checkpoints[i]
+        if i + 1 < len(self.checkpoints):
+            next_pos, next_cpos, d = self.checkpoints[i + 1]
+        else:
+            next_pos = self.last_position
+            next_cpos = self.last_compressed_position
+        if next_pos <= pos:
+            return cpos
+        return cpos + (next_cpos - cpos) * (position - pos) // (next_pos - pos)
+
+# Read blocks of complete lines from a gzip compressed g-code file
+class GzipReader:
+    def __init__(self, f, position, gzip_checkpoints):
+        self.f = f
+        self.gzip_checkpoints = gzip_checkpoints
+        pos, cpos, decompressor = gzip_checkpoints.lookup(position)
+        self.decompressor = decompressor.copy()
+        self.position = pos
+        self.compressed_position = cpos
+        f.seek(cpos)
+        # Skip forward from the checkpoint to the requested position
+        self.partial_input = self.next_data = ""
+        while self.position < position:
+            skip = position - self.position
+            data = self._decompress()
+            if not data:
+                break
+            if len(data) > skip:
+                self.next_data = data[skip:]
+                break
+    def _decompress(self):
+        while 1:
+            cdata = self.f.read(READ_SIZE)
+            if not cdata:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(cdata)
+            self.compressed_position += len(cdata)
+            self.position += len(data)
+            self.gzip_checkpoints.note_position(
+                self.position, self.compressed_position, self.decompressor)
+            if data:
+                return data
+    def read_block(self):
+        # Returns the next block of complete lines (or "" at end of file)
+        while 1:
+            data = self.next_data
+            if data:
+                self.next_data = ""
+            else:
+                data = self._decompress()
+            if not data:
+                return ""
+            pos = data.rfind('\n') + 1
+            if not pos:
+                self.partial_input += data
+                continue
+            block = self.partial_input + data[:pos]
+            self.partial_input = data[pos:]
+            return block
+    def close(self):
+        pass
+
+PREFETCH_WAIT_TIME = 0.100
+
+# Read blocks ahead of the print in a background thread (so that slow
+# storage does not stall the reactor)
+class PrefetchReader:
+    def __init__(self, reactor, reader, f, max_blocks):
+        self.reactor = reactor
+        self.max_blocks = max_blocks
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.blocks = collections.deque()
+        self.buffered_bytes = 0
+        self.is_eof = self.must_exit = False
+        self.error = None
+        self.completion = None
+        self.stall_time = 0.
+        # The background thread closes the reader and its file
+        self.reader = reader
+        self.f = f
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+    def _bg_thread(self):
+        try:
+            while 1:
+                with self.lock:
+                    while (len(self.blocks) >= self.max_blocks
+                           and not self.must_exit):
+                        self.cond.wait()
+                    if self.must_exit:
+                        break
+                error = None
+                try:
+                    data = self.reader.read_block()
+                except Exception as e:
+                    logging.exception("virtual_sdcard prefetch")
+                    data = ""
+                    error = e
+                with self.lock:
+                    if data:
+                        self.blocks.append(data)
+                        self.buffered_bytes += len(data)
+                    else:
+                        self.is_eof = True
+                        self.error = error
+                    completion = self.completion
+                    self.completion = None
+                if completion is not None:
+                    self.reactor.async_complete(completion, None)
+                if not data:
+                    break
+        finally:
+            self.reader.close()
+            self.f.close()
+    def read_block(self):
+        # Returns the next block of complete lines, "" at end of file,
+        # or None if no data arrived within PREFETCH_WAIT_TIME
+        with self.lock:
+            completion = None
+            if not self.blocks and not self.is_eof:
+                completion = self.completion = self.reactor.completion()
+        if completion is not None:
+            start_time = self.reactor.monotonic()
+            completion.wait(start_time + PREFETCH_WAIT_TIME)
+            self.stall_time += self.reactor.monotonic() - start_time
+        with self.lock:
+            if self.blocks:
+                data = self.blocks.popleft()
+                self.buffered_bytes -= len(data)
+                self.cond.notify()
+                return data
+            if self.error is not None:
+                raise self.error
+            if self.is_eof:
+                return ""
+            return None
+    def get_stats(self):
+        with self.lock:
+            return self.buffered_bytes, self.stall_time
+    def close(self):
+        with self.lock:
+            self.must_exit = True
+            self.blocks.clear()
+            self.buffered_bytes = 0
+            self.cond.notify()
+
 class VirtualSD:
     def __init__(self, config):
         printer = config.get_printer()
@@ -14,14 +309,21 @@ class VirtualSD:
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
+        self.file_list_cache = FileListCache(self.sdcard_dirname)
         self.current_file = None
         self.file_position = self.file_size = 0
+        self.gzip_checkpoints = None
+        self.is_binary = False
         # Print Stat Tracking
         self.print_stats = printer.load_object(config, 'print_stats')
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
         self.work_timer = None
+        self.batch_lines = config.getint('batch_lines', 1, minval=1)
+        self.batch_time = config.getfloat('batch_time', 0.050, above=0.)
+        self.prefetch_blocks = config.getint('prefetch_blocks', 0, minval=0)
+        self.prefetch_reader = None
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         for cmd in ['M20', 'M21', 'M23', 'M24', 'M25', 'M26', 'M27']:
@@ -37,6 +339,10 @@ class VirtualSD:
     def handle_shutdown(self):
         if self.work_timer is not None:
             self.must_pause_work = True
+            if self.gzip_checkpoints is not None:
+                logging.info("Virtual sdcard compressed file position %d",
+                             self.file_position)
+                return
             try:
                 readpos = max(self.file_position - 1024, 0)
                 readcount = self.file_position - readpos
@@ -51,21 +357,14 @@ class VirtualSD:
     def stats(self, eventtime):
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        msg = "sd_pos=%d" % (self.file_position,)
+        if self.prefetch_reader is not None:
+            msg += " sd_buffer=%d sd_stall=%.3f" % (
+                self.prefetch_reader.get_stats())
+        return True, msg
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
-            flist = []
-            for root, dirs, files in os.walk(
-                    self.sdcard_dirname, followlinks=True):
-                for name in files:
-                    ext = name[name.rfind('.')+1:]
-                    if ext not in VALID_GCODE_EXTS:
-                        continue
-                    full_path = os.path.join(root, name)
-                    r_path = full_path[len(self.sdcard_dirname) + 1:]
-                    size = os.path.getsize(full_path)
-                    flist.append((r_path, size))
-            return sorted(flist, key=lambda f: f[0].lower())
+            return self.file_list_cache.get_file_list()
         else:
             dname = self.sdcard_dirname
             try:
@@ -77,10 +376,16 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error("Unable to get file list")
+    def _get_progress_position(self):
+        # Progress of compressed files is based on the compressed bytes
+        if self.gzip_checkpoints is not None:
+            return self.gzip_checkpoints.get_compressed_position(
+                self.file_position)
+        return self.file_position
     def get_status(self, eventtime):
         progress = 0.
         if self.file_size:
-            progress = float(self.file_position) / self.file_size
+            progress = float(self._get_progress_position()) / self.file_size
         is_active = self.is_active()
         return {'progress': progress, 'is_active': is_active,
                 'file_position': self.file_position}
@@ -100,6 +405,8 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
         self.file_position = self.file_size = 0.
+        self.gzip_checkpoints = None
+        self.is_binary = False
         self.print_stats.reset()
     cmd_SDCARD_RESET_FILE_help = "Clears a loaded SD File. Stops the print "\
         "if necessary"
@@ -117,8 +424,49 @@ class VirtualSD:
         filename = gcmd.get("FILENAME")
         if filename[0] == '/':
             filename = filename[1:]
+        layer = gcmd.get_int('LAYER', None, minval=0)
+        height = gcmd.get_float('Z', None)
         self._load_file(gcmd, filename, check_subdirs=True)
+        if layer is not None or height is not None:
+            self._seek_layer(gcmd, layer, height)
         self.cmd_M24(gcmd)
+    def _get_index(self, gcmd):
+        # Load (or build) the file index in a background thread
+        filename = self.current_file.name
+        index = gcode_index.load_index(filename)
+        if index is not None:
+            return index
+        gcmd.respond_info("Indexing file %s" % (filename,))
+        completion = self.reactor.completion()
+        def bg_index():
+            try:
+                index = gcode_index.get_index(filename)
+            except:
+                logging.exception("virtual_sdcard index")
+                index = None
+            self.reactor.async_complete(completion, index)
+        bg_thread = threading.Thread(target=bg_index)
+        bg_thread.daemon = True
+        bg_thread.start()
+        index = completion.wait()
+        if index is None:
+            raise gcmd.error("Unable to index file")
+        return index
+    def _seek_layer(self, gcmd, layer, height):
+        if self.is_binary:
+            raise gcmd.error("Can not select a layer in a binary g-code file")
+        index = self._get_index(gcmd)
+        if layer is not None:
+            cp = index.lookup_layer(layer)
+        else:
+            cp = index.lookup_height(height)
+        if cp is None:
+            raise gcmd.error("Requested layer not found (file has %d layers)"
+                             % (index.get_layer_count(),))
+        gcmd.respond_info("Starting at file position %d (layer Z=%.3f)"
+                          % (cp.offset, cp.layer_z))
+        self.gcode.run_script_from_command(cp.get_restore_script())
+        self.file_position = cp.offset
     def cmd_M20(self, gcmd):
         # List SD card
         files = self.get_file_list()
@@ -145,12 +493,19 @@ class VirtualSD:
             filename = filename[1:]
         self._load_file(gcmd, filename)
     def _load_file(self, gcmd, filename, check_subdirs=False):
-        files = self.get_file_list(check_subdirs)
-        files_by_lower = { fname.lower(): fname for fname, fsize in files }
+        if check_subdirs:
+            fname = self.file_list_cache.lookup(filename)
+        else:
+            files = self.get_file_list()
+            files_by_lower = { fname.lower(): fname for fname, fsize in files }
+            fname = files_by_lower.get(filename.lower())
         try:
-            fname = files_by_lower[filename.lower()]
+            if fname is None:
+                raise IOError("File %s not found" % (filename,))
             fname = os.path.join(self.sdcard_dirname, fname)
             f = open(fname, 'rb')
+            header = f.read(binary_gcode.HEADER_SIZE)
+            is_gzip = header.startswith('\x1f\x8b')
             f.seek(0, os.SEEK_END)
             fsize = f.tell()
             f.seek(0)
@@ -162,6 +517,9 @@ class VirtualSD:
         self.current_file = f
         self.file_position = 0
         self.file_size = fsize
+        if is_gzip:
+            self.gzip_checkpoints = GzipCheckpoints()
+        self.is_binary = binary_gcode.is_binary(header)
         self.print_stats.set_current_file(filename)
     def cmd_M24(self, gcmd):
         # Start/resume SD print
@@ -185,29 +543,79 @@ class VirtualSD:
             gcmd.respond_raw("Not SD printing.")
             return
         gcmd.respond_raw("SD printing byte %d/%d"
-                         % (self.file_position, self.file_size))
+                         % (self._get_progress_position(), self.file_size))
     # Background work timer
+    def _dispatch_batch(self, lines, moves, sizes):
+        # Run up to batch_lines commands (for up to batch_time seconds)
+        # while holding the gcode mutex.  Stop early if a pause is
+        # requested or another task is waiting on the mutex.
+        gcode_mutex = self.gcode.get_mutex()
+        end_time = self.reactor.monotonic() + self.batch_time
+        for i in range(self.batch_lines):
+            self.gcode.run_script_from_command(lines[-1], moves[-1:])
+            self.file_position += sizes.pop()
+            lines.pop()
+            moves.pop()
+            if (not lines or self.must_pause_work
+                or gcode_mutex.has_waiters()
+                or self.reactor.monotonic() >= end_time):
+                break
+    def _create_reader(self, f):
+        if self.is_binary:
+            # Records start after the file header
+            self.file_position = max(self.file_position,
+                                     binary_gcode.HEADER_SIZE)
+            return BinaryReader(f, self.file_position)
+        if self.gzip_checkpoints is not None:
+            return GzipReader(f, self.file_position, self.gzip_checkpoints)
+        return FileReader(f, self.file_position)
+    def _open_reader(self):
+        if not self.prefetch_blocks:
+            return self._create_reader(self.current_file)
+        # Use a separate file handle for the background thread
+        f = open(self.current_file.name, 'rb')
+        try:
+            reader = self._create_reader(f)
+        except:
+            f.close()
+            raise
+        self.prefetch_reader = PrefetchReader(self.reactor, reader, f,
+                                              self.prefetch_blocks)
+        return self.prefetch_reader
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
         try:
-            self.current_file.seek(self.file_position)
+            reader = self._open_reader()
         except:
             logging.exception("virtual_sdcard seek")
             self.work_timer = None
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
         lines = []
+        moves = []
+        sizes = []
+        partial_input = ""
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    data = reader.read_block()
+                    if data and self.is_binary:
+                        data = partial_input + data
+                        lines, moves, sizes, used = (
+                            binary_gcode.decode_records(data))
+                        partial_input = data[used:]
+                    elif data:
+                        lines, moves = self.gcode.split_input(data)[:2]
+                        sizes = [len(line) + 1 for line in lines]
                 except:
                     logging.exception("virtual_sdcard read")
                     break
+                if data is None:
+                    # Still waiting on the background reader
+                    continue
                 if not data:
                     # End of file
                     self.current_file.close()
@@ -215,20 +623,20 @@ class VirtualSD:
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
                 lines.reverse()
+                moves.reverse()
+                sizes.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
             try:
-                self.gcode.run_script(lines[-1])
+                with gcode_mutex:
+                    self._dispatch_batch(lines, moves, sizes)
             except self.gcode.error as e:
                 self.print_stats.note_error(str(e))
                 break
@@ -236,8 +644,9 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position += len(lines.pop()) + 1
         logging.info("Exiting SD card print (position %d)", self.file_position)
+        reader.close()
+        self.prefetch_reader = None
         self.work_timer = None
         self.cmd_from_sd = False
         if self.current_file is not None:
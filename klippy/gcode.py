@@ -3,8 +3,11 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, re, logging, collections, shlex
-import homing
+import os, re, logging, collections
+import homing, chelper, binary_gcode
+
+EXTENDED_CACHE_SIZE = 128
+OUTPUT_FLUSH_SIZE = 4096
 
 class GCodeCommand:
     error = homing.CommandError
@@ -83,7 +86,14 @@ class GCodeDispatch:
         self.base_gcode_handlers = self.gcode_handlers = {}
         self.ready_gcode_handlers = {}
         self.mux_commands = {}
+        self.move_handlers = {}
         self.gcode_help = {}
+        self.extended_cache = collections.OrderedDict()
+        # C tokenizer for batches of input lines
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.tokens_size = 256
+        self.tokens = self.ffi_main.new('struct gcode_line[]',
+                                        self.tokens_size)
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -118,6 +128,12 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
+    def register_move_handler(self, cmd, func, move_func):
+        # Register an optimized handler for plain G0/G1 move commands.
+        # The move_func is passed a dictionary of already parsed X, Y,
+        # Z, E, F float parameters.  It is only used while 'func' is the
+        # registered handler for 'cmd'.
+        self.move_handlers[cmd] = (func, move_func)
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -151,30 +167,99 @@ class GCodeDispatch:
         self._respond_state("Ready")
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
-    def _process_commands(self, commands, need_ack=True):
-        for line in commands:
-            # Ignore comments and leading/trailing spaces
-            line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            numparts = len(parts)
-            cmd = ""
-            if numparts >= 3 and parts[1] != 'N':
-                cmd = parts[1] + parts[2].strip()
-            elif numparts >= 5 and parts[1] == 'N':
-                # Skip line number at start of command
-                cmd = parts[3] + parts[4].strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, numparts, 2) }
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
-            # Invoke handler for command
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
+    move_r = re.compile(
+        r'G([01])((?:\s*[XYZEF][-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))*)\s*$')
+    move_params_r = re.compile(r'([XYZEF])([-+.0-9]+)')
+    def _clean_line(self, line):
+        # Ignore comments and leading/trailing spaces
+        origline = line.strip()
+        cpos = origline.find(';')
+        if cpos >= 0:
+            return origline, origline[:cpos].upper()
+        return origline, origline.upper()
+    def _parse_move(self, line):
+        # Check for a plain G0/G1 move (with only X, Y, Z, E, F
+        # parameters) that can be passed directly to a move handler
+        m = self.move_r.match(line)
+        if m is None:
+            return None
+        return 'G' + m.group(1), {
+            a: float(v) for a, v in self.move_params_r.findall(m.group(2))}
+    def _get_move_handler(self, cmd, params):
+        func, move_func = self.move_handlers.get(cmd, (None, None))
+        if func is None or func != self.gcode_handlers.get(cmd):
+            return None
+        if params.get('F', 1.) <= 0.:
+            # Report invalid speed via the regular command handler
+            return None
+        return move_func
+    def split_input(self, data):
+        # Split raw input into lines and use the C tokenizer to parse
+        # any plain G0/G1 moves.  Returns the list of complete lines, a
+        # matching list of parsed moves (or None), and the trailing
+        # partial line.
+        lines = data.split('\n')
+        partial = lines.pop()
+        count = len(lines)
+        moves = [None] * count
+        if count > self.tokens_size:
+            self.tokens_size = max(count, 2 * self.tokens_size)
+            self.tokens = self.ffi_main.new('struct gcode_line[]',
+                                            self.tokens_size)
+        tokens = self.tokens
+        num = self.ffi_lib.gcode_tokenize(tokens, count, data, len(data))
+        ffi_string = self.ffi_main.string
+        move_cmds = ('G0', 'G1')
+        for i in range(num):
+            t = tokens[i]
+            cmd_num = t.cmd_num
+            if cmd_num > 1 or t.cmd != 'G':
+                continue
+            letters = ffi_string(t.param_letters)
+            if letters.strip('XYZEF'):
+                continue
+            moves[t.line] = (move_cmds[cmd_num],
+                             dict(zip(letters, t.param_values)))
+        return lines, moves, partial
+    def _process_commands(self, commands, need_ack=True, moves=None,
+                          done_callback=None):
+        if moves is None:
+            moves = [None] * len(commands)
+        for line, move in zip(commands, moves):
+            origline = None
+            if move is None:
+                origline, line = self._clean_line(line)
+                move = self._parse_move(line)
+            handler = gcmd = None
+            if move is not None:
+                cmd, params = move
+                handler = self._get_move_handler(cmd, params)
+            if handler is None:
+                if move is not None and not line:
+                    # Moves from binary g-code files have no text
+                    line = binary_gcode.format_move(*move)
+                if origline is None:
+                    origline, line = self._clean_line(line)
+                # Break line into parts and determine command
+                parts = self.args_r.split(line)
+                numparts = len(parts)
+                cmd = ""
+                if numparts >= 3 and parts[1] != 'N':
+                    cmd = parts[1] + parts[2].strip()
+                elif numparts >= 5 and parts[1] == 'N':
+                    # Skip line number at start of command
+                    cmd = parts[3] + parts[4].strip()
+                # Build gcode "params" dictionary
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(1, numparts, 2) }
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+                # Invoke handler for command
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
-                handler(gcmd)
+                if gcmd is None:
+                    handler(params)
+                else:
+                    handler(gcmd)
             except self.error as e:
                 self._respond_error(str(e))
                 self.printer.send_event("gcode:command_error")
@@ -187,12 +272,19 @@ class GCodeDispatch:
                 self._respond_error(msg)
                 if not need_ack:
                     raise
-            gcmd.ack()
-    def run_script_from_command(self, script):
-        self._process_commands(script.split('\n'), need_ack=False)
-    def run_script(self, script):
+            if gcmd is not None:
+                gcmd.ack()
+            elif need_ack:
+                self.respond_raw("ok")
+            if done_callback is not None:
+                done_callback()
+    def run_script_from_command(self, script, moves=None):
+        self._process_commands(script.split('\n'), need_ack=False,
+                               moves=moves)
+    def run_script(self, script, moves=None):
         with self.mutex:
-            self._process_commands(script.split('\n'), need_ack=False)
+            self._process_commands(script.split('\n'), need_ack=False,
+                                   moves=moves)
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -222,21 +314,58 @@ class GCodeDispatch:
         r'(?P<cmd>[a-zA-Z_][a-zA-Z0-9_]+)(?:\s+|$)'
         r'(?P<args>[^#*;]*?)'
         r'\s*(?:[#*;].*)?$')
+    # Single pass lexer with the same rules as shlex.split() - a
+    # backslash outside quotes escapes the next character, and inside
+    # double quotes it only escapes a double quote or backslash
+    extended_args_r = re.compile(
+        r"""([ \t\r\n]+)|([^ \t\r\n'"\\]+)|\\(.)|'([^']*)'"""
+        r"""|"((?:[^"\\]|\\.)*)"|(.)""", re.S)
+    double_quote_escape_r = re.compile(r'\\(["\\])')
+    def _split_extended_args(self, eargs):
+        args = []
+        arg = None
+        for m in self.extended_args_r.finditer(eargs):
+            space, word, escaped, squote, dquote, other = m.groups()
+            if space is not None:
+                if arg is not None:
+                    args.append(arg)
+                    arg = None
+                continue
+            if other is not None:
+                raise ValueError("Unterminated quote or escape")
+            if arg is None:
+                arg = ""
+            if word is not None:
+                arg += word
+            elif escaped is not None:
+                arg += escaped
+            elif squote is not None:
+                arg += squote
+            else:
+                arg += self.double_quote_escape_r.sub(r'\1', dquote)
+        if arg is not None:
+            args.append(arg)
+        return args
     def _get_extended_params(self, gcmd):
-        m = self.extended_r.match(gcmd.get_commandline())
-        if m is None:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
-        eargs = m.group('args')
-        try:
-            eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
-            eparams = { k.upper(): v for k, v in eparams }
-            gcmd._params.clear()
-            gcmd._params.update(eparams)
-            return gcmd
-        except ValueError as e:
-            raise self.error("Malformed command '%s'"
-                             % (gcmd.get_commandline(),))
+        commandline = gcmd.get_commandline()
+        eparams = self.extended_cache.pop(commandline, None)
+        if eparams is None:
+            m = self.extended_r.match(commandline)
+            if m is None:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            try:
+                eparams = [earg.split('=', 1) for earg in
+                           self._split_extended_args(m.group('args'))]
+                eparams = { k.upper(): v for k, v in eparams }
+            except ValueError as e:
+                raise self.error("Malformed command '%s'" % (commandline,))
+            if len(self.extended_cache) >= EXTENDED_CACHE_SIZE:
+                self.extended_cache.popitem(last=False)
+        # Most recently used entries are kept at the end of the cache
+        self.extended_cache[commandline] = eparams
+        gcmd._params.clear()
+        gcmd._params.update(eparams)
+        return gcmd
     # G-Code special command handlers
     def cmd_default(self, gcmd):
         cmd = gcmd.get_command()
@@ -333,6 +462,8 @@ class GCodeIO:
         self.printer = printer
         printer.register_event_handler("klippy:ready", self._handle_ready)
         printer.register_event_handler("klippy:shutdown", self._handle_shutdown)
+        printer.register_event_handler("klippy:disconnect",
+                                       self._flush_output)
         self.gcode = printer.lookup_object('gcode')
         self.gcode_mutex = self.gcode.get_mutex()
         self.fd = printer.get_start_args().get("gcode_fd")
@@ -340,16 +471,38 @@ class GCodeIO:
         self.is_printer_ready = False
         self.is_processing_data = False
         self.is_fileinput = not not printer.get_start_args().get("debuginput")
+        self.read_size = 16384
+        if self.is_fileinput:
+            # Batch mode - read the debug input file in large chunks
+            self.read_size = 64 * 1024
+        # Input flow control - stop reading input once queue_high
+        # commands are pending and resume once at most queue_low remain
+        self.queue_high = 100
+        self.queue_low = 25
         self.pipe_is_active = True
+        self.output_buffer = []
+        self.output_size = 0
+        self.is_output_pending = False
         self.fd_handle = None
         if not self.is_fileinput:
             self.gcode.register_output_handler(self._respond_raw)
             self.fd_handle = self.reactor.register_fd(self.fd,
                                                       self._process_data)
+        self.is_binary_input = False
         self.partial_input = ""
         self.pending_commands = []
-        self.bytes_read = 0
+        self.pending_moves = []
+        self.processing_count = 0
+        self.bytes_read = self.read_count = 0
         self.input_log = collections.deque([], 50)
+    def load_config(self, config):
+        read_size = config.getint('read_size', self.read_size, minval=1)
+        self.queue_high = config.getint('queue_high_watermark',
+                                        self.queue_high, minval=2)
+        self.queue_low = config.getint('queue_low_watermark', self.queue_low,
+                                       minval=0, maxval=self.queue_high - 1)
+        if not self.is_fileinput:
+            self.read_size = read_size
     def _handle_ready(self):
         self.is_printer_ready = True
         if self.is_fileinput and self.fd_handle is None:
@@ -368,21 +521,48 @@ class GCodeIO:
         self._dump_debug()
         if self.is_fileinput:
             self.printer.request_exit('error_exit')
-    m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
+    def _split_input(self, data):
+        if self.is_binary_input:
+            lines, moves, sizes, used = binary_gcode.decode_records(data)
+            return lines, moves, data[used:]
+        return self.gcode.split_input(data)
+    def _get_queue_depth(self):
+        # Commands read but not yet completed
+        return len(self.pending_commands) + self.processing_count
+    def _pause_input(self):
+        if self.fd_handle is not None:
+            self.reactor.unregister_fd(self.fd_handle)
+            self.fd_handle = None
+    def _resume_input(self):
+        if self.fd_handle is None:
+            self.fd_handle = self.reactor.register_fd(self.fd,
+                                                      self._process_data)
+    def _note_command_done(self):
+        self.processing_count -= 1
+        if (self.fd_handle is None
+            and self._get_queue_depth() <= self.queue_low):
+            self._resume_input()
+    m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)', re.MULTILINE)
     def _process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
         try:
-            data = os.read(self.fd, 4096)
+            data = os.read(self.fd, self.read_size)
         except os.error:
             logging.exception("Read g-code")
             return
         self.input_log.append((eventtime, data))
+        input_data = self.partial_input + data
+        if (self.is_fileinput and not self.bytes_read
+            and binary_gcode.is_binary(data)):
+            # Debug input file is in the binary g-code format
+            self.is_binary_input = True
+            input_data = data[binary_gcode.HEADER_SIZE:]
         self.bytes_read += len(data)
-        lines = data.split('\n')
-        lines[0] = self.partial_input + lines[0]
-        self.partial_input = lines.pop()
+        self.read_count += 1
+        lines, moves, self.partial_input = self._split_input(input_data)
         pending_commands = self.pending_commands
         pending_commands.extend(lines)
+        self.pending_moves.extend(moves)
         self.pipe_is_active = True
         # Special handling for debug file input EOF
         if not data and self.is_fileinput:
@@ -391,40 +571,66 @@ class GCodeIO:
                 self.fd_handle = None
                 self.gcode.request_restart('exit')
             pending_commands.append("")
+            self.pending_moves.append(None)
         # Handle case where multiple commands pending
         if self.is_processing_data or len(pending_commands) > 1:
-            if len(pending_commands) < 20:
-                # Check for M112 out-of-order
-                for line in lines:
-                    if self.m112_r.match(line) is not None:
-                        self.gcode.cmd_M112(None)
+            # Check for M112 out-of-order (in a single search of all the
+            # newly read lines)
+            if lines and self.m112_r.search("\n".join(lines)) is not None:
+                self.gcode.cmd_M112(None)
             if self.is_processing_data:
-                if len(pending_commands) >= 20:
+                if self._get_queue_depth() >= self.queue_high:
                     # Stop reading input
-                    self.reactor.unregister_fd(self.fd_handle)
-                    self.fd_handle = None
+                    self._pause_input()
                 return
         # Process commands
         self.is_processing_data = True
         while pending_commands:
+            pending_moves = self.pending_moves
             self.pending_commands = []
+            self.pending_moves = []
+            self.processing_count = len(pending_commands)
             with self.gcode_mutex:
-                self.gcode._process_commands(pending_commands)
+                self.gcode._process_commands(
+                    pending_commands, moves=pending_moves,
+                    done_callback=self._note_command_done)
+            self.processing_count = 0
             pending_commands = self.pending_commands
         self.is_processing_data = False
-        if self.fd_handle is None:
-            self.fd_handle = self.reactor.register_fd(self.fd,
-                                                      self._process_data)
+        self._resume_input()
     def _respond_raw(self, msg):
+        # Responses are written together once per reactor iteration (or
+        # immediately once OUTPUT_FLUSH_SIZE bytes are queued)
+        self.output_buffer.append(msg)
+        self.output_size += len(msg) + 1
+        if self.output_size >= OUTPUT_FLUSH_SIZE:
+            self._flush_output()
+        elif not self.is_output_pending:
+            self.is_output_pending = True
+            self.reactor.register_callback(self._flush_output_callback)
+    def _flush_output_callback(self, eventtime):
+        self.is_output_pending = False
+        self._flush_output()
+    def _flush_output(self):
+        if not self.output_buffer:
+            return
+        msg = "\n".join(self.output_buffer) + "\n"
+        self.output_buffer = []
+        self.output_size = 0
         if self.pipe_is_active:
             try:
-                os.write(self.fd, msg+"\n")
+                os.write(self.fd, msg)
             except os.error:
                 logging.exception("Write g-code response")
                 self.pipe_is_active = False
     def stats(self, eventtime):
-        return False, "gcodein=%d" % (self.bytes_read,)
+        return False, "gcodein=%d gcodein_reads=%d gcodein_queue=%d" % (
+            self.bytes_read, self.read_count, self._get_queue_depth())
 
 def add_early_printer_objects(printer):
     printer.add_object('gcode', GCodeDispatch(printer))
     printer.add_object('gcode_io', GCodeIO(printer))
+
+def add_printer_objects(config):
+    gcode_io = config.get_printer().lookup_object('gcode_io')
+    gcode_io.load_config(config.getsection('gcode_io'))
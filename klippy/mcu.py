@@ -382,6 +382,7 @@ class CommandWrapper:
 
 class MCU:
     error = error
+    FILE_WRITE_BUFFER = 256 * 1024
     def __init__(self, config, clocksync):
         self._printer = config.get_printer()
         self._clocksync = clocksync
@@ -488,7 +489,13 @@ class MCU:
         dfile = open(dict_fname, 'rb')
         dict_data = dfile.read()
         dfile.close()
-        self._serial.connect_file(outfile, dict_data)
+        # In batch mode (reading from a debug input file) nothing
+        # watches the output in real-time, so write it in large blocks
+        write_buffer = 0
+        if start_args.get('debuginput') is not None:
+            write_buffer = self.FILE_WRITE_BUFFER
+        self._serial.connect_file(outfile, dict_data,
+                                  write_buffer=write_buffer)
         self._clocksync.connect_file(self._serial, pace)
         # Handle pacing
         if not pace:
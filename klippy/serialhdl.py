@@ -124,12 +124,16 @@ class SerialReader:
         if receive_window is not None:
             self.ffi_lib.serialqueue_set_receive_window(
                 self.serialqueue, receive_window)
-    def connect_file(self, debugoutput, dictionary, pace=False):
+    def connect_file(self, debugoutput, dictionary, pace=False,
+                     write_buffer=0):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
         self.serialqueue = self.ffi_main.gc(
             self.ffi_lib.serialqueue_alloc(self.ser.fileno(), 1),
             self.ffi_lib.serialqueue_free)
+        if write_buffer:
+            self.ffi_lib.serialqueue_set_write_buffer(self.serialqueue,
+                                                      write_buffer)
     def set_clock_est(self, freq, last_time, last_clock):
         self.ffi_lib.serialqueue_set_clock_est(
             self.serialqueue, freq, last_time, last_clock)
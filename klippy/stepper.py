@@ -40,6 +40,8 @@ class MCU_stepper:
                                       self._ffi_lib.stepcompress_free)
         self._mcu.register_stepqueue(self._stepqueue)
         self._stepper_kinematics = None
+        self._analytic = False
+        self._shared_steps = None
         self._itersolve_generate_steps = self._ffi_lib.itersolve_generate_steps
         self._itersolve_check_active = self._ffi_lib.itersolve_check_active
         self._trapq = ffi_main.NULL
@@ -67,6 +69,16 @@ class MCU_stepper:
         ffi_main, ffi_lib = chelper.get_ffi()
         sk = ffi_main.gc(getattr(ffi_lib, alloc_func)(*params), ffi_lib.free)
         self.set_stepper_kinematics(sk)
+    def set_analytic_solver(self, analytic):
+        # Calculate step times directly on kinematics that support it
+        self._analytic = analytic
+        self.set_stepper_kinematics(self._stepper_kinematics)
+    def set_shared_steps(self, shared_steps):
+        # Steppers with identical kinematics may reuse the step times
+        # calculated for the first stepper in the shared group
+        self._shared_steps = shared_steps
+        self._ffi_lib.itersolve_set_shared(self._stepper_kinematics,
+                                           shared_steps)
     def _build_config(self):
         max_error = self._mcu.get_max_stepper_error()
         min_stop_interval = max(0., self._min_stop_interval - max_error)
@@ -126,6 +138,7 @@ class MCU_stepper:
         if sk is not None:
             self._ffi_lib.itersolve_set_stepcompress(sk, self._stepqueue,
                                                      self._step_dist)
+            self._ffi_lib.itersolve_set_analytic(sk, self._analytic)
             self.set_trapq(self._trapq)
         return old_sk
     def note_homing_end(self, did_trigger=False):
@@ -186,6 +199,8 @@ def PrinterStepper(config, units_in_radians=False):
     step_dist = config.getfloat('step_distance', above=0.)
     mcu_stepper = MCU_stepper(name, step_pin_params, dir_pin_params, step_dist,
                               units_in_radians)
+    mcu_stepper.set_analytic_solver(
+        config.getboolean('analytic_step_generation', False))
     # Support for stepper enable pin handling
     stepper_enable = printer.load_object(config, 'stepper_enable')
     stepper_enable.register_stepper(mcu_stepper, config.get('enable_pin', None))
@@ -208,6 +223,7 @@ class PrinterRail:
         self.stepper_units_in_radians = units_in_radians
         self.steppers = []
         self.endstops = []
+        self.share_steps = config.getboolean('share_step_generation', False)
         self.add_extra_stepper(config)
         mcu_stepper = self.steppers[0]
         self.get_commanded_position = mcu_stepper.get_commanded_position
@@ -295,6 +311,13 @@ class PrinterRail:
     def setup_itersolve(self, alloc_func, *params):
         for stepper in self.steppers:
             stepper.setup_itersolve(alloc_func, *params)
+        if self.share_steps and len(self.steppers) > 1:
+            # All steppers on the rail share the same kinematics
+            ffi_main, ffi_lib = chelper.get_ffi()
+            shared_steps = ffi_main.gc(ffi_lib.itersolve_shared_alloc(),
+                                       ffi_lib.itersolve_shared_free)
+            for stepper in self.steppers:
+                stepper.set_shared_steps(shared_steps)
     def generate_steps(self, flush_time):
         for stepper in self.steppers:
             stepper.generate_steps(flush_time)
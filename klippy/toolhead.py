@@ -3,31 +3,40 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, logging, importlib
-import mcu, homing, chelper, kinematics.extruder
+import math, logging, importlib, array
+import mcu, homing, stepper, chelper, kinematics.extruder
 
 # Common suffixes: _d is distance (in mm), _v is velocity (in
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
 # Class to track each move request
-class Move:
+class Move(object):
+    # Moves are allocated for every G1 - keep them compact
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'timing_callbacks',
+        'is_kinematic_move', 'axes_d', 'move_d', 'axes_r', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2',
+        'max_smoothed_v2', 'smooth_delta_v2',
+        'start_v', 'cruise_v', 'end_v', 'accel_t', 'cruise_t', 'decel_t',
+        'lookahead_state')
     def __init__(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
         self.accel = toolhead.max_accel
-        self.timing_callbacks = []
+        self.timing_callbacks = ()
         velocity = min(speed, toolhead.max_velocity)
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
-        self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
+        sx, sy, sz, se = self.start_pos
+        dx, dy, dz = end_pos[0] - sx, end_pos[1] - sy, end_pos[2] - sz
+        de = end_pos[3] - se
+        self.move_d = move_d = math.sqrt(dx*dx + dy*dy + dz*dz)
         if move_d < .000000001:
             # Extrude only move
-            self.end_pos = (start_pos[0], start_pos[1], start_pos[2],
-                            end_pos[3])
-            axes_d[0] = axes_d[1] = axes_d[2] = 0.
-            self.move_d = move_d = abs(axes_d[3])
+            self.end_pos = (sx, sy, sz, end_pos[3])
+            dx = dy = dz = 0.
+            self.move_d = move_d = abs(de)
             inv_move_d = 0.
             if move_d:
                 inv_move_d = 1. / move_d
@@ -36,7 +45,9 @@ class Move:
             self.is_kinematic_move = False
         else:
             inv_move_d = 1. / move_d
-        self.axes_r = [d * inv_move_d for d in axes_d]
+        self.axes_d = (dx, dy, dz, de)
+        self.axes_r = (dx * inv_move_d, dy * inv_move_d, dz * inv_move_d,
+                       de * inv_move_d)
         self.min_move_t = move_d / velocity
         # Junction speeds are tracked in velocity squared.  The
         # delta_v2 is the maximum amount of this squared-velocity that
@@ -46,6 +57,7 @@ class Move:
         self.delta_v2 = 2.0 * move_d * self.accel
         self.max_smoothed_v2 = 0.
         self.smooth_delta_v2 = 2.0 * move_d * toolhead.max_accel_to_decel
+        self.lookahead_state = None
     def limit_speed(self, speed, accel):
         speed2 = speed**2
         if speed2 < self.max_cruise_v2:
@@ -169,6 +181,18 @@ class MoveQueue:
                 delayed.append((move, start_v2, next_end_v2))
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
+            if update_flush_count:
+                # If the state passed to the earlier moves matches the
+                # last lazy pass then that pass already determined the
+                # earlier moves can't be flushed yet.  (Only the presence
+                # of a peak_cruise_v2 and delayed moves matter until a
+                # flush point is found.)  Each lazy pass still walks
+                # back from the last move to the first converged move.
+                state = (start_v2, smoothed_v2,
+                         not peak_cruise_v2, not delayed)
+                if state == move.lookahead_state:
+                    return
+                move.lookahead_state = state
         if update_flush_count or not flush_count:
             return
         # Generate step times for all moves ready to be flushed
@@ -188,9 +212,13 @@ class MoveQueue:
 MIN_KIN_TIME = 0.100
 MOVE_BATCH_TIME = 0.500
 SDS_CHECK_TIME = 0.001 # step+dir+step filter in stepcompress.c
+APPEND_MOVE_FIELDS = 13 # doubles per 'struct append_move' in trapq.h
 
 DRIP_SEGMENT_TIME = 0.050
 DRIP_TIME = 0.100
+
+LATENCY_DECAY = 0.99 # per update decay of the tracked host latency
+LATENCY_MARGIN = 4. # target ratio of buffer_time_low to host latency
 class DripModeEndSignal(Exception):
     pass
 
@@ -229,6 +257,19 @@ class ToolHead:
             'buffer_time_high', 2.000, above=self.buffer_time_low)
         self.buffer_time_start = config.getfloat(
             'buffer_time_start', 0.250, above=0.)
+        self.config_buffer_times = (self.buffer_time_low,
+                                    self.buffer_time_high,
+                                    self.buffer_time_start)
+        # Adaptive buffer time tracking
+        self.adaptive_buffer_time = config.getboolean(
+            'adaptive_buffer_time', False)
+        self.min_buffer_time_scale = config.getfloat(
+            'min_buffer_time_scale', 0.5, above=0., maxval=1.)
+        self.max_buffer_time_scale = config.getfloat(
+            'max_buffer_time_scale', 2., minval=1.)
+        self.buffer_time_scale = 1.
+        self.host_latency = 0.
+        self.flush_waketime = 0.
         self.move_flush_time = config.getfloat(
             'move_flush_time', 0.050, above=0.)
         self.print_time = 0.
@@ -246,9 +287,23 @@ class ToolHead:
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
-        self.trapq_append = ffi_lib.trapq_append
+        self.trapq_append_moves = ffi_lib.trapq_append_moves
         self.trapq_free_moves = ffi_lib.trapq_free_moves
+        self.ffi_main = ffi_main
         self.step_generators = []
+        # Optional worker threads for step generation
+        self.step_pool = None
+        sg_threads = config.getint('step_generation_threads', 0, minval=0)
+        if sg_threads:
+            step_pool = ffi_lib.itersolve_pool_alloc(sg_threads)
+            if step_pool == ffi_main.NULL:
+                logging.warning("Unable to create step generation threads"
+                                " - using serial step generation")
+            else:
+                self.step_pool = ffi_main.gc(step_pool,
+                                             ffi_lib.itersolve_pool_free)
+                self.step_pool_begin = ffi_lib.itersolve_pool_begin
+                self.step_pool_flush = ffi_lib.itersolve_pool_flush
         # Create kinematics class
         self.extruder = kinematics.extruder.DummyExtruder(self.printer)
         kin_name = config.get('kinematics')
@@ -277,6 +332,17 @@ class ToolHead:
         for module_name in modules:
             self.printer.load_object(config, module_name)
     # Print time tracking
+    def _generate_steps_parallel(self, flush_time):
+        # Step generation requests are queued by the step generators
+        # and then run on the worker threads
+        self.step_pool_begin(self.step_pool)
+        try:
+            for sg in self.step_generators:
+                sg(flush_time)
+        finally:
+            ret = self.step_pool_flush(self.step_pool)
+        if ret:
+            raise stepper.error("Internal error in stepcompress")
     def _update_move_time(self, next_print_time):
         batch_time = MOVE_BATCH_TIME
         kin_flush_delay = self.kin_flush_delay
@@ -284,8 +350,11 @@ class ToolHead:
         while 1:
             self.print_time = min(self.print_time + batch_time, next_print_time)
             sg_flush_time = max(lkft, self.print_time - kin_flush_delay)
-            for sg in self.step_generators:
-                sg(sg_flush_time)
+            if self.step_pool is not None:
+                self._generate_steps_parallel(sg_flush_time)
+            else:
+                for sg in self.step_generators:
+                    sg(sg_flush_time)
             free_time = max(lkft, sg_flush_time - kin_flush_delay)
             self.trapq_free_moves(self.trapq, free_time)
             self.extruder.update_move_time(free_time)
@@ -311,24 +380,33 @@ class ToolHead:
                 # Transition from "Flushed"/"Priming" state to main state
                 self.special_queuing_state = ""
                 self.need_check_stall = -1.
+                self.flush_waketime = 0.
                 self.reactor.update_timer(self.flush_timer, self.reactor.NOW)
             self._calc_print_time()
         # Queue moves into trapezoid motion queue (trapq)
         next_move_time = self.print_time
+        kin_moves = []
         for move in moves:
             if move.is_kinematic_move:
-                self.trapq_append(
-                    self.trapq, next_move_time,
+                kin_moves.extend((
+                    next_move_time,
                     move.accel_t, move.cruise_t, move.decel_t,
                     move.start_pos[0], move.start_pos[1], move.start_pos[2],
                     move.axes_r[0], move.axes_r[1], move.axes_r[2],
-                    move.start_v, move.cruise_v, move.accel)
+                    move.start_v, move.cruise_v, move.accel))
             if move.axes_d[3]:
                 self.extruder.move(next_move_time, move)
             next_move_time = (next_move_time + move.accel_t
                               + move.cruise_t + move.decel_t)
             for cb in move.timing_callbacks:
                 cb(next_move_time)
+        if kin_moves:
+            ffi_main = self.ffi_main
+            buf = array.array('d', kin_moves)
+            am = ffi_main.cast('struct append_move *',
+                               ffi_main.from_buffer(buf))
+            self.trapq_append_moves(self.trapq, am,
+                                    len(kin_moves) // APPEND_MOVE_FIELDS)
         # Generate steps for moves
         if self.special_queuing_state:
             self._update_drip_move_time(next_move_time)
@@ -339,6 +417,7 @@ class ToolHead:
         self.move_queue.flush()
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
+        self.flush_waketime = 0.
         self.reactor.update_timer(self.flush_timer, self.reactor.NEVER)
         self.move_queue.set_flush_time(self.buffer_time_high)
         self.idle_flush_print_time = 0.
@@ -363,11 +442,18 @@ class ToolHead:
                 est_print_time = self.mcu.estimated_print_time(eventtime)
                 if est_print_time < self.idle_flush_print_time:
                     self.print_stall += 1
+                    # The buffer ran dry - treat the length of the
+                    # resulting pause in movement as a host latency
+                    stall_time = (est_print_time + self.buffer_time_start
+                                  - self.idle_flush_print_time)
+                    if stall_time > 0.:
+                        self._note_latency(stall_time)
                 self.idle_flush_print_time = 0.
             # Transition from "Flushed"/"Priming" state to "Priming" state
             self.special_queuing_state = "Priming"
             self.need_check_stall = -1.
-            self.reactor.update_timer(self.flush_timer, eventtime + 0.100)
+            self.flush_waketime = eventtime + 0.100
+            self.reactor.update_timer(self.flush_timer, self.flush_waketime)
         # Check if there are lots of queued moves and stall if so
         while 1:
             est_print_time = self.mcu.estimated_print_time(eventtime)
@@ -378,18 +464,24 @@ class ToolHead:
             if not self.can_pause:
                 self.need_check_stall = self.reactor.NEVER
                 return
-            eventtime = self.reactor.pause(eventtime + min(1., stall_time))
+            waketime = eventtime + min(1., stall_time)
+            eventtime = self.reactor.pause(waketime)
+            self._note_latency(eventtime - waketime)
         if not self.special_queuing_state:
             # In main state - defer stall checking until needed
             self.need_check_stall = (est_print_time + self.buffer_time_high
                                      + 0.100)
     def _flush_handler(self, eventtime):
         try:
+            if self.flush_waketime:
+                self._note_latency(eventtime - self.flush_waketime)
             print_time = self.print_time
             buffer_time = print_time - self.mcu.estimated_print_time(eventtime)
             if buffer_time > self.buffer_time_low:
                 # Running normally - reschedule check
-                return eventtime + buffer_time - self.buffer_time_low
+                self.flush_waketime = (eventtime + buffer_time
+                                       - self.buffer_time_low)
+                return self.flush_waketime
             # Under ran low buffer mark - flush lookahead queue
             self.flush_step_generation()
             if print_time != self.print_time:
@@ -397,7 +489,24 @@ class ToolHead:
         except:
             logging.exception("Exception in flush_handler")
             self.printer.invoke_shutdown("Exception in flush_handler")
+        self.flush_waketime = 0.
         return self.reactor.NEVER
+    def _note_latency(self, latency):
+        # Track a slowly decaying maximum of the host scheduling delays
+        self.host_latency = max(latency, self.host_latency * LATENCY_DECAY)
+        if not self.adaptive_buffer_time:
+            return
+        # Size the buffer window so that the low water mark is a
+        # multiple of the host latency (within the configured bounds)
+        low, high, start = self.config_buffer_times
+        scale = max(LATENCY_MARGIN * self.host_latency / low,
+                    self.buffer_time_scale * LATENCY_DECAY)
+        scale = min(max(scale, self.min_buffer_time_scale),
+                    self.max_buffer_time_scale)
+        self.buffer_time_scale = scale
+        self.buffer_time_low = low * scale
+        self.buffer_time_high = high * scale
+        self.buffer_time_start = start * scale
     # Movement commands
     def get_position(self):
         return list(self.commanded_pos)
@@ -463,6 +572,7 @@ class ToolHead:
         self.move_queue.flush()
         self.special_queuing_state = "Drip"
         self.need_check_stall = self.reactor.NEVER
+        self.flush_waketime = 0.
         self.reactor.update_timer(self.flush_timer, self.reactor.NEVER)
         self.move_queue.set_flush_time(self.buffer_time_high)
         self.idle_flush_print_time = 0.
@@ -489,8 +599,12 @@ class ToolHead:
         is_active = buffer_time > -60. or not self.special_queuing_state
         if self.special_queuing_state == "Drip":
             buffer_time = 0.
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
+        msg = "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
             self.print_time, max(buffer_time, 0.), self.print_stall)
+        if self.adaptive_buffer_time:
+            msg += " buffer_time_low=%.3f host_latency=%.3f" % (
+                self.buffer_time_low, self.host_latency)
+        return is_active, msg
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -506,7 +620,10 @@ class ToolHead:
                      'max_velocity': self.max_velocity,
                      'max_accel': self.max_accel,
                      'max_accel_to_decel': self.requested_accel_to_decel,
-                     'square_corner_velocity': self.square_corner_velocity})
+                     'square_corner_velocity': self.square_corner_velocity,
+                     'buffer_time_low': self.buffer_time_low,
+                     'buffer_time_high': self.buffer_time_high,
+                     'host_latency': self.host_latency})
         return res
     def _handle_shutdown(self):
         self.can_pause = False
@@ -531,7 +648,7 @@ class ToolHead:
         if last_move is None:
             callback(self.get_last_move_time())
             return
-        last_move.timing_callbacks.append(callback)
+        last_move.timing_callbacks += (callback,)
     def note_kinematic_activity(self, kin_time):
         self.last_kin_move_time = max(self.last_kin_move_time, kin_time)
     def get_max_velocity(self):
@@ -0,0 +1,135 @@
+#!/usr/bin/env python2
+# Benchmark (and check) the g-code command parsing and dispatch code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor, gcode, homing
+from extras import gcode_move
+
+# Lines that exercise the differences between the G0/G1 fast path and
+# the regular g-code parser
+TEST_LINES = [
+    "G90", "G1 X10 Y20 Z0.3 F3000", "g1 x11 y21", "G1X12Y22E1.5",
+    "G0 X-1.5 Y+2. Z.5", "G1 X13 Y23 ; comment", "N10 G1 X14 Y24*57",
+    "G1 X15 X16", "G1 F0", "G1 F-10", "G1 X", "G1 X1.2.3", "G1 X1e2",
+    "G1 X17 S1", "G01 X18", "G1.0 X19", "G 1 X20", "G1 E", "M83",
+    "G1 E1 F1800", "G91", "G1 X1 Y1 E0.1", "G0 Z1", "G92 E0", "M82",
+    "G1 E2", "G90", "G1 X30 Y30 E3", "G1   X31   Y31   ", "G1 X32 E+.5",
+    "n20 g1 x33 y33 *99", "G1 X34 *", "G1 X35 *5 Y35", "\tG1 X36\r",
+    "G00 X37", "N5", "G1 X38 ; Y1 *5", "G1 X1 Y2 Z3 E4 F100 X5 Y6 Z7 E8",
+    "G1 X39-1", "G1 X40 Y_1", "G1 X41Y41", "M104 S0",
+]
+
+
+######################################################################
+# Minimal printer objects
+######################################################################
+
+class DummyPrinter:
+    command_error = homing.CommandError
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+        self.objects = {}
+        self.event_handlers = {}
+    def get_start_args(self):
+        return {}
+    def get_reactor(self):
+        return self.reactor
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+class DummyConfig:
+    def __init__(self, printer):
+        self.printer = printer
+    def get_printer(self):
+        return self.printer
+
+class DummyToolHead:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.moves = []
+    def get_position(self):
+        return list(self.position)
+    def move(self, newpos, speed):
+        self.position[:] = newpos
+        self.moves.append((tuple(newpos), speed))
+
+def setup(mode):
+    printer = DummyPrinter()
+    gcode_dispatch = gcode.GCodeDispatch(printer)
+    printer.objects['gcode'] = gcode_dispatch
+    toolhead = DummyToolHead()
+    printer.objects['toolhead'] = toolhead
+    gcode_move.GCodeMove(DummyConfig(printer))
+    # Homing is not simulated
+    gcode_dispatch.register_command('G28', None)
+    gcode_dispatch.register_command('G28', lambda gcmd: None)
+    if mode == "regular":
+        gcode_dispatch.move_handlers.clear()
+    printer.send_event("klippy:ready")
+    responses = []
+    gcode_dispatch.register_output_handler(responses.append)
+    return gcode_dispatch, toolhead, responses
+
+def run(lines, mode):
+    gcode_dispatch, toolhead, responses = setup(mode)
+    start_time = time.time()
+    if mode == "tokenizer":
+        # Feed the input in blocks (as GCodeIO and virtual_sdcard do)
+        data = "\n".join(lines) + "\n"
+        partial = ""
+        for pos in range(0, len(data), 8192):
+            cmds, moves, partial = gcode_dispatch.split_input(
+                partial + data[pos:pos+8192])
+            gcode_dispatch._process_commands(cmds, moves=moves)
+    else:
+        gcode_dispatch._process_commands(lines)
+    run_time = time.time() - start_time
+    return run_time, toolhead.moves, responses
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] [gcode files]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    # Don't report the errors from invalid test lines
+    logging.disable(logging.WARNING)
+
+    tests = [("test lines", TEST_LINES * 1000)]
+    for fname in args:
+        f = open(fname, 'rb')
+        tests.append((fname, f.read().split('\n')))
+        f.close()
+    modes = ["regular", "fast path", "tokenizer"]
+    for name, lines in tests:
+        results = {}
+        for mode in modes:
+            res = [run(lines, mode) for i in range(options.repeat)]
+            run_time = min([r[0] for r in res])
+            results[mode] = (len(lines) / run_time, res[0][1:])
+        for mode in modes[1:]:
+            if results[mode][1] != results["regular"][1]:
+                sys.stderr.write("\n\n%s: %s results differ!\n\n" % (
+                    name, mode))
+                sys.exit(-1)
+        base_rate = results["regular"][0]
+        sys.stdout.write("%s: %d lines: %s\n" % (name, len(lines), ", ".join(
+            ["%s %.0f lines/s (%.2fx)" % (mode, results[mode][0],
+                                          results[mode][0] / base_rate)
+             for mode in modes])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+# Benchmark the analytic and iterative itersolve step time solvers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math, random, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper
+
+MCU_FREQ = 16000000.
+MAX_ERROR = .000025
+BATCH_TIME = .100
+
+# Stepper kinematics to test: (alloc_func, param, (x, y, z) coefficients)
+KINEMATICS = [
+    ("cartesian", 'cartesian_stepper_alloc', 'x', (1., 0., 0.)),
+    ("corexy", 'corexy_stepper_alloc', '+', (1., 1., 0.)),
+    ("corexz", 'corexz_stepper_alloc', '-', (1., 0., -1.)),
+]
+
+
+######################################################################
+# Move generation
+######################################################################
+
+# Generate a list of random moves (each starting and ending at rest)
+def gen_moves(count, velocity, accel, seed):
+    rand = random.Random(seed)
+    moves = []
+    pos = (100., 100., 10.)
+    print_time = .100
+    for i in range(count):
+        newpos = (rand.uniform(0., 200.), rand.uniform(0., 200.),
+                  min(max(pos[2] + rand.uniform(-1., 1.), 0.), 20.))
+        axes_d = [n - p for n, p in zip(newpos, pos)]
+        move_d = math.sqrt(sum([d*d for d in axes_d]))
+        if not move_d:
+            continue
+        axes_r = [d / move_d for d in axes_d]
+        cruise_v = min(velocity, math.sqrt(move_d * accel))
+        accel_t = cruise_v / accel
+        cruise_t = (move_d - cruise_v * accel_t) / cruise_v
+        moves.append((print_time, accel_t, cruise_t, accel_t,
+                      pos, axes_r, cruise_v, accel))
+        print_time += 2. * accel_t + cruise_t
+        pos = newpos
+    return moves, print_time
+
+# Total stepper travel (steppers never reverse during a single move)
+def calc_travel(moves, coefs):
+    travel = 0.
+    for print_time, accel_t, cruise_t, decel_t, pos, axes_r, v, a in moves:
+        move_d = v * (accel_t + cruise_t)
+        travel += abs(sum([c * r for c, r in zip(coefs, axes_r)])) * move_d
+    return travel
+
+
+######################################################################
+# Step generation
+######################################################################
+
+def run_test(moves, end_time, alloc_func, param, step_dist, iterative):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    tq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    for print_time, accel_t, cruise_t, decel_t, pos, axes_r, v, a in moves:
+        ffi_lib.trapq_append(tq, print_time, accel_t, cruise_t, decel_t,
+                             pos[0], pos[1], pos[2],
+                             axes_r[0], axes_r[1], axes_r[2], 0., v, a)
+    sc = ffi_main.gc(ffi_lib.stepcompress_alloc(0), ffi_lib.stepcompress_free)
+    ffi_lib.stepcompress_fill(sc, int(MAX_ERROR * MCU_FREQ), 0, 1, 2)
+    sync = ffi_main.gc(ffi_lib.steppersync_alloc(ffi_main.NULL, [sc], 1, 1),
+                       ffi_lib.steppersync_free)
+    ffi_lib.steppersync_set_time(sync, 0., MCU_FREQ)
+    sk = ffi_main.gc(getattr(ffi_lib, alloc_func)(param), ffi_lib.free)
+    ffi_lib.itersolve_set_analytic(sk, not iterative)
+    ffi_lib.itersolve_set_stepcompress(sk, sc, step_dist)
+    pos = moves[0][4]
+    ffi_lib.itersolve_set_position(sk, pos[0], pos[1], pos[2])
+    ffi_lib.itersolve_set_trapq(sk, tq)
+    generate_steps = ffi_lib.itersolve_generate_steps
+    start_time = time.time()
+    flush_time = 0.
+    while flush_time < end_time:
+        flush_time += BATCH_TIME
+        ret = generate_steps(sk, flush_time)
+        if ret:
+            raise Exception("Error generating steps")
+    return time.time() - start_time
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--moves", type="int", dest="moves", default=2000,
+                    help="number of random moves to generate")
+    opts.add_option("-s", "--step_distance", type="float", dest="step_dist",
+                    default=.0125, help="stepper step distance")
+    opts.add_option("-v", "--velocity", type="float", dest="velocity",
+                    default=300., help="maximum velocity (mm/s)")
+    opts.add_option("-a", "--accel", type="float", dest="accel",
+                    default=3000., help="acceleration (mm/s^2)")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+
+    moves, end_time = gen_moves(options.moves, options.velocity,
+                                options.accel, 0)
+    for name, alloc_func, param, coefs in KINEMATICS:
+        steps = calc_travel(moves, coefs) / options.step_dist
+        results = []
+        for iterative in [True, False]:
+            best = min([run_test(moves, end_time, alloc_func, param,
+                                 options.step_dist, iterative)
+                        for i in range(options.repeat)])
+            results.append(steps / best)
+        sys.stdout.write("%-10s %9d steps: iterative %.0f steps/s,"
+                         " analytic %.0f steps/s (%.2fx)\n" % (
+                             name, steps, results[0], results[1],
+                             results[1] / results[0]))
+
+if __name__ == '__main__':
+    main()
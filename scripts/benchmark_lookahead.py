@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# Benchmark the toolhead.Move creation and MoveQueue lookahead code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead, kinematics.extruder
+
+
+######################################################################
+# Minimal toolhead
+######################################################################
+
+class DummyToolHead:
+    def __init__(self, max_velocity, max_accel):
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        scv2 = 5.**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / max_accel
+        self.extruder = kinematics.extruder.DummyExtruder(None)
+        self.move_queue = toolhead.MoveQueue(self)
+        self.move_queue.set_flush_time(2.000)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.print_time = 0.
+    def _process_moves(self, moves):
+        for m in moves:
+            self.print_time += m.accel_t + m.cruise_t + m.decel_t
+    def move(self, newpos, speed):
+        move = toolhead.Move(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+
+
+######################################################################
+# Generated move sequences
+######################################################################
+
+# Extruding spiral of short segments (as produced by vase mode prints)
+def spiral_moves(count):
+    moves = []
+    for i in range(count):
+        angle = i * .05
+        radius = 50. + 20. * math.sin(i * .0005)
+        moves.append(([radius * math.cos(angle), radius * math.sin(angle),
+                       i * .0001, i * .002], 100.))
+    return moves
+
+# Infill style zig-zag of long moves
+def zigzag_moves(count):
+    moves = []
+    for i in range(count):
+        moves.append(([((i + 1) // 2 % 2) * 150., (i // 2) * .4, 0.,
+                       i * .5], 200.))
+    return moves
+
+# Long low acceleration ramps along the sides of a square (where lazy
+# lookahead passes find no flush point for many moves)
+def ramp_moves(count):
+    moves = []
+    pos = [0., 0.]
+    for i in range(count):
+        side = i // 1000
+        axis, sign = side % 2, 1. - 2. * ((side // 2) % 2)
+        pos[axis] += sign * 2.
+        moves.append(([pos[0], pos[1], 0., 0.], 500.))
+    return moves
+
+def run(moves, max_velocity, max_accel):
+    th = DummyToolHead(max_velocity, max_accel)
+    start_time = time.time()
+    for newpos, speed in moves:
+        th.move(newpos, speed)
+    th.move_queue.flush()
+    run_time = time.time() - start_time
+    return run_time, th.print_time
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count",
+                    default=200000, help="number of moves in each test")
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of times to run each test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+
+    tests = [("spiral", spiral_moves(options.count), 300., 3000.),
+             ("zigzag", zigzag_moves(options.count), 300., 3000.),
+             ("ramps", ramp_moves(options.count), 500., 100.)]
+    for name, moves, max_velocity, max_accel in tests:
+        res = [run(moves, max_velocity, max_accel)
+               for i in range(options.repeat)]
+        run_time = min([r[0] for r in res])
+        sys.stdout.write("%s: %d moves: %.0f moves/s (print time %.3fs)\n" % (
+            name, len(moves), len(moves) / run_time, res[0][1]))
+
+if __name__ == '__main__':
+    main()
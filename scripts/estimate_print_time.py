@@ -0,0 +1,339 @@
+#!/usr/bin/env python2
+# Estimate the print time of a g-code file using the host lookahead
+#
+# Each line is run through the g-code dispatcher, the move checks of
+# the configured kinematics, and the lookahead.  This processes about
+# 50k moves per second (most of the time is spent parsing the g-code
+# and in the lookahead).
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, logging, collections, importlib
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor, configfile, gcode, homing, pins, toolhead
+import kinematics.extruder
+from extras import gcode_move
+
+BATCH_LINES = 1000
+
+
+######################################################################
+# Minimal printer objects
+######################################################################
+
+class EstimatorPrinter:
+    config_error = configfile.error
+    command_error = homing.CommandError
+    def __init__(self, config_file):
+        self.start_args = {'config_file': config_file}
+        self.reactor = reactor.Reactor()
+        self.objects = collections.OrderedDict()
+        self.event_handlers = {}
+        self.error_count = 0
+    def get_start_args(self):
+        return self.start_args
+    def get_reactor(self):
+        return self.reactor
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def lookup_object(self, name, default=configfile.sentinel):
+        if name in self.objects:
+            return self.objects[name]
+        if default is configfile.sentinel:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+    def load_object(self, config, section):
+        return self.lookup_object(section)
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def set_rollover_info(self, name, info, log=True):
+        pass
+    def invoke_shutdown(self, msg):
+        # Report the error and continue with the next line
+        self.error_count += 1
+
+# Micro-controller that accepts the stepper and endstop setup of the
+# kinematics (no commands are ever sent)
+class EstimatorMCU:
+    def __init__(self, printer, position_endstop=None):
+        self.printer = printer
+        self.position_endstop = position_endstop
+        self.oid_count = 0
+    def get_printer(self):
+        return self.printer
+    def create_oid(self):
+        self.oid_count += 1
+        return self.oid_count - 1
+    def register_config_callback(self, cb):
+        pass
+    def register_stepqueue(self, stepqueue):
+        pass
+    def setup_pin(self, pin_type, pin_params):
+        if pin_type != 'endstop':
+            raise pins.error("Pin type '%s' not supported" % (pin_type,))
+        return EstimatorEndstop(self.position_endstop)
+
+class EstimatorEndstop:
+    def __init__(self, position_endstop):
+        self.steppers = []
+        if position_endstop is not None:
+            self.get_position_endstop = (lambda: position_endstop)
+    def add_stepper(self, stepper):
+        self.steppers.append(stepper)
+    def get_steppers(self):
+        return list(self.steppers)
+
+# Stepper enable, force_move, and query_endstops registrations
+class EstimatorRegistry:
+    def register_stepper(self, *args):
+        pass
+    def register_endstop(self, mcu_endstop, name):
+        pass
+
+# Homing that moves the toolhead to the homed position without timing
+# the homing moves
+class EstimatorHoming(homing.Homing):
+    def home_rails(self, rails, forcepos, movepos):
+        homing_axes = [axis for axis in range(3) if forcepos[axis] is not None]
+        self.toolhead.set_position(self._fill_coord(movepos),
+                                   homing_axes=homing_axes)
+
+class EstimatorGCodeMove(gcode_move.GCodeMove):
+    def cmd_G28(self, gcmd):
+        axes = []
+        for pos, axis in enumerate('XYZ'):
+            if gcmd.get(axis, None) is not None:
+                axes.append(pos)
+        if not axes:
+            axes = [0, 1, 2]
+        homing_state = EstimatorHoming(self.printer)
+        homing_state.home_axes(axes)
+        for axis in homing_state.get_axes():
+            self.base_position[axis] = self.homing_position[axis]
+
+class EstimatorHeater:
+    can_extrude = True
+
+# Extruder using the extrusion limits of kinematics.extruder
+class EstimatorExtruder(kinematics.extruder.PrinterExtruder):
+    def __init__(self, config, max_velocity, max_accel):
+        self.printer = config.get_printer()
+        self.name = config.get_name()
+        self.heater = EstimatorHeater()
+        self.nozzle_diameter = config.getfloat('nozzle_diameter', above=0.)
+        filament_diameter = config.getfloat(
+            'filament_diameter', minval=self.nozzle_diameter)
+        self.filament_area = math.pi * (filament_diameter * .5)**2
+        def_max_cross_section = 4. * self.nozzle_diameter**2
+        def_max_extrude_ratio = def_max_cross_section / self.filament_area
+        max_cross_section = config.getfloat(
+            'max_extrude_cross_section', def_max_cross_section, above=0.)
+        self.max_extrude_ratio = max_cross_section / self.filament_area
+        self.max_e_velocity = config.getfloat(
+            'max_extrude_only_velocity', max_velocity * def_max_extrude_ratio
+            , above=0.)
+        self.max_e_accel = config.getfloat(
+            'max_extrude_only_accel', max_accel * def_max_extrude_ratio
+            , above=0.)
+        self.max_e_dist = config.getfloat(
+            'max_extrude_only_distance', 50., minval=0.)
+        self.instant_corner_v = config.getfloat(
+            'instantaneous_corner_velocity', 1., minval=0.)
+
+
+######################################################################
+# Toolhead that accumulates move times
+######################################################################
+
+class EstimatorToolHead(toolhead.ToolHead):
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.move_queue = toolhead.MoveQueue(self)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.max_velocity = config.getfloat('max_velocity', above=0.)
+        self.max_accel = config.getfloat('max_accel', above=0.)
+        self.requested_accel_to_decel = config.getfloat(
+            'max_accel_to_decel', self.max_accel * 0.5, above=0.)
+        self.max_accel_to_decel = self.requested_accel_to_decel
+        self.square_corner_velocity = config.getfloat(
+            'square_corner_velocity', 5., minval=0.)
+        self.config_max_velocity = self.max_velocity
+        self.config_max_accel = self.max_accel
+        self.config_square_corner_velocity = self.square_corner_velocity
+        self.junction_deviation = 0.
+        self._calc_junction_deviation()
+        self.move_queue.set_flush_time(config.getfloat(
+            'buffer_time_high', 2.000, above=0., note_valid=False))
+        self.print_time = 0.
+        self.need_check_stall = self.printer.get_reactor().NEVER
+        # Use the limits of the configured kinematics
+        self.extruder = kinematics.extruder.DummyExtruder(self.printer)
+        kin_name = config.get('kinematics')
+        mod = importlib.import_module('kinematics.' + kin_name)
+        self.kin = mod.load_kinematics(self, config)
+        if config.has_section('extruder'):
+            self.extruder = EstimatorExtruder(config.getsection('extruder'),
+                                              self.max_velocity,
+                                              self.max_accel)
+        # Statistics
+        self.requested_speeds = collections.deque()
+        self.move_count = 0
+        self.layers = [[None, 0.]]
+        self.limited = {'speed': [0, 0., 0.], 'accel': [0, 0., 0.]}
+        # Register commands
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command('G4', self.cmd_G4)
+        gcode.register_command('M400', self.cmd_M400)
+        gcode.register_command('SET_VELOCITY_LIMIT',
+                               self.cmd_SET_VELOCITY_LIMIT,
+                               desc=self.cmd_SET_VELOCITY_LIMIT_help)
+        gcode.register_command('M204', self.cmd_M204)
+    def move(self, newpos, speed):
+        self.requested_speeds.append(speed)
+        oldpos = list(self.commanded_pos)
+        try:
+            toolhead.ToolHead.move(self, newpos, speed)
+        except:
+            self.requested_speeds.pop()
+            raise
+        if self.commanded_pos == oldpos:
+            # No move was queued
+            self.requested_speeds.pop()
+    def _process_moves(self, moves):
+        layers = self.layers
+        for move in moves:
+            move_t = move.accel_t + move.cruise_t + move.decel_t
+            self.print_time += move_t
+            self.move_count += 1
+            # Check for a new layer (an xy extrusion move at a new height)
+            if move.axes_d[3] > 0. and (move.axes_d[0] or move.axes_d[1]):
+                z = move.end_pos[2]
+                if z != layers[-1][0]:
+                    layers.append([z, 0.])
+            layers[-1][1] += move_t
+            # Note moves that did not reach the requested velocity
+            speed = self.requested_speeds.popleft()
+            if move.cruise_v >= speed * .999:
+                continue
+            if move.max_cruise_v2 < (speed * .999)**2:
+                limit = self.limited['speed']
+            else:
+                limit = self.limited['accel']
+            limit[0] += 1
+            limit[1] += move_t
+            limit[2] += move_t - move.move_d / speed
+    def get_trapq(self):
+        return None
+    def register_step_generator(self, handler):
+        pass
+    def flush_step_generation(self):
+        self.move_queue.flush()
+    def get_last_move_time(self):
+        self.move_queue.flush()
+        return self.print_time
+    def set_position(self, newpos, homing_axes=()):
+        self.move_queue.flush()
+        self.commanded_pos[:] = newpos
+        self.kin.set_position(newpos, homing_axes)
+        self.printer.send_event("toolhead:set_position")
+    def dwell(self, delay):
+        self.move_queue.flush()
+        self.print_time += max(0., delay)
+        self.layers[-1][1] += max(0., delay)
+    def wait_moves(self):
+        self.move_queue.flush()
+
+
+######################################################################
+# Startup
+######################################################################
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds + .5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+def estimate(config_file, gcode_file):
+    printer = EstimatorPrinter(config_file)
+    gcode_dispatch = gcode.GCodeDispatch(printer)
+    printer.add_object('gcode', gcode_dispatch)
+    pconfig = configfile.PrinterConfig(printer)
+    config = pconfig.read_main_config()
+    ppins = pins.PrinterPins()
+    printer.add_object('pins', ppins)
+    ppins.register_chip('mcu', EstimatorMCU(printer))
+    for s in config.get_prefix_sections('mcu '):
+        ppins.register_chip(s.get_name()[4:], EstimatorMCU(printer))
+    if config.has_section('probe'):
+        z_offset = config.getsection('probe').getfloat(
+            'z_offset', note_valid=False)
+        ppins.register_chip('probe', EstimatorMCU(printer, z_offset))
+    registry = EstimatorRegistry()
+    for name in ['stepper_enable', 'force_move', 'query_endstops']:
+        printer.add_object(name, registry)
+    th = EstimatorToolHead(config.getsection('printer'))
+    printer.add_object('toolhead', th)
+    printer.add_object('gcode_move', EstimatorGCodeMove(config))
+    def note_error():
+        printer.error_count += 1
+    printer.register_event_handler("gcode:command_error", note_error)
+    printer.send_event("klippy:ready")
+    # Feed the g-code file through the g-code dispatcher
+    start_time = time.time()
+    line_count = 0
+    f = open(gcode_file, 'rb')
+    while 1:
+        lines = f.readlines(BATCH_LINES * 40)
+        if not lines:
+            break
+        line_count += len(lines)
+        for line in lines:
+            try:
+                gcode_dispatch.run_script_from_command(line.rstrip('\n'))
+            except Exception:
+                # Errors are counted by the error handlers above
+                pass
+    f.close()
+    th.wait_moves()
+    run_time = time.time() - start_time
+    return th, line_count, run_time
+
+def main():
+    usage = "%prog [options] <printer.cfg> <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-l", "--layers", action="store_true", dest="layers",
+                    help="report the time of each layer")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.WARNING)
+
+    th, line_count, run_time = estimate(args[0], args[1])
+
+    print("Estimated print time: %s (%.3f seconds)" % (
+        format_time(th.print_time), th.print_time))
+    print("Moves: %d  Layers: %d" % (th.move_count, len(th.layers) - 1))
+    if th.printer.error_count:
+        print("Commands with errors (not timed): %d" % (
+            th.printer.error_count,))
+    for name, desc in [('speed', "velocity limits"),
+                       ('accel', "acceleration")]:
+        count, move_t, extra_t = th.limited[name]
+        print("Moves limited by %s: %d (%.3f seconds, %.3f seconds over"
+              " requested speed)" % (desc, count, move_t, extra_t))
+    if options.layers:
+        for i, (z, layer_t) in enumerate(th.layers):
+            if z is None:
+                print("Before first layer: %s (%.3f seconds)" % (
+                    format_time(layer_t), layer_t))
+                continue
+            print("Layer %d z=%.3f: %s (%.3f seconds)" % (
+                i, z, format_time(layer_t), layer_t))
+    sys.stderr.write("Processed %d lines (%d moves) in %.3f seconds"
+                     " (%.0f moves/s)\n" % (
+                         line_count, th.move_count, run_time,
+                         th.move_count / max(run_time, .001)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python2
+# Convert g-code files to (and from) the pre-tokenized binary format
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import binary_gcode
+
+def main():
+    usage = "%prog [options] <input file> <output file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--decode", action="store_true", dest="decode",
+                    help="convert a binary file back to g-code text")
+    opts.add_option("-c", "--check", action="store_true", dest="check",
+                    help="verify the conversion round-trips")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+    infilename, outfilename = args
+    f = open(infilename, 'rb')
+    data = f.read()
+    f.close()
+    try:
+        if options.decode:
+            out = binary_gcode.decode_to_text(data)
+        else:
+            if binary_gcode.is_binary(data):
+                opts.error("Input file is already in the binary format")
+            out = binary_gcode.encode(data)
+        if options.check:
+            # Converting the output back must reproduce it exactly
+            if options.decode:
+                check = binary_gcode.decode_to_text(binary_gcode.encode(out))
+            else:
+                check = binary_gcode.encode(binary_gcode.decode_to_text(out))
+            if check != out:
+                sys.stderr.write("Round-trip check failed\n")
+                sys.exit(-1)
+    except binary_gcode.error as e:
+        sys.stderr.write("Unable to convert %s: %s\n" % (infilename, str(e)))
+        sys.exit(-1)
+    f = open(outfilename, 'wb')
+    f.write(out)
+    f.close()
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,17 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, optparse, logging, subprocess
+import sys, os, optparse, logging, subprocess, filecmp
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
 
 TEMP_GCODE_FILE = "_test_.gcode"
 TEMP_LOG_FILE = "_test_.log"
 TEMP_OUTPUT_FILE = "_test_output"
+TEMP_BINARY_FILE = "_test_.bgcode"
+TEMP_BINARY_OUTPUT_FILE = TEMP_OUTPUT_FILE + "_binary"
+TEMP_COMPARE_OUTPUT_FILE = TEMP_OUTPUT_FILE + "_compare"
+STOP_TIME = .500
 
 
 ######################################################################
@@ -17,6 +23,70 @@ TEMP_OUTPUT_FILE = "_test_output"
 class error(Exception):
     pass
 
+# Parse an mcu output file into the list of messages sent to each oid
+def load_dictionary(dict_fname):
+    f = open(dict_fname, 'rb')
+    dictionary = f.read()
+    f.close()
+    mp = msgproto.MessageParser()
+    mp.process_identify(dictionary, decompress=False)
+    return mp
+
+def parse_output(fname, mp):
+    f = open(fname, 'rb')
+    data = f.read()
+    f.close()
+    streams = {}
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            raise error("Invalid data in output file %s" % (fname,))
+        for msg in mp.dump(bytearray(data[:l]))[1:]:
+            oid = None
+            for param in msg.split()[1:]:
+                if param.startswith('oid='):
+                    oid = int(param[4:])
+                    break
+            streams.setdefault(oid, []).append(msg)
+        data = data[l:]
+    return streams
+
+# Return the (clock, direction) of each step, given the messages sent
+# to a stepper oid
+def calc_step_clocks(msgs):
+    sdir = clock = 0
+    steps = []
+    for msg in msgs:
+        parts = msg.split()
+        params = dict(p.split('=', 1) for p in parts[1:])
+        if parts[0] == 'set_next_step_dir':
+            sdir = int(params['dir'])
+        elif parts[0] == 'reset_step_clock':
+            clock = int(params['clock'])
+        elif parts[0] == 'queue_step':
+            interval = int(params['interval'])
+            add = int(params['add'])
+            for i in range(int(params['count'])):
+                clock = (clock + interval) & 0xffffffff
+                interval += add
+                steps.append((clock, sdir))
+    return steps
+
+# Return the positions (in steps) at which a stepper stops for at
+# least min_gap clock ticks, given the messages sent to its oid
+def calc_stepper_stops(msgs, min_gap):
+    pos = 0
+    last_step = None
+    stops = []
+    for clock, sdir in calc_step_clocks(msgs):
+        if (last_step is not None
+            and (clock - last_step) & 0xffffffff >= min_gap):
+            stops.append(pos)
+        pos += 1 if sdir else -1
+        last_step = clock
+    stops.append(pos)
+    return stops
+
 class TestCase:
     def __init__(self, fname, dictdir, tempdir, verbose, keepfiles):
         self.fname = fname
@@ -35,7 +105,9 @@ class TestCase:
     def parse_test(self):
         # Parse file into test cases
         config_fname = gcode_fname = dict_fnames = None
-        should_fail = multi_tests = False
+        should_fail = multi_tests = binary_replay = False
+        compare_fname = None
+        compare_opts = []
         gcode = []
         f = open(self.fname, 'rb')
         for line in f:
@@ -51,11 +123,15 @@ class TestCase:
                     if not multi_tests:
                         multi_tests = True
                         self.launch_test(config_fname, dict_fnames,
-                                         gcode_fname, gcode, should_fail)
+                                         gcode_fname, gcode, should_fail,
+                                         binary_replay, compare_fname,
+                                         compare_opts)
                 config_fname = self.relpath(parts[1])
                 if multi_tests:
                     self.launch_test(config_fname, dict_fnames,
-                                     gcode_fname, gcode, should_fail)
+                                     gcode_fname, gcode, should_fail,
+                                     binary_replay, compare_fname,
+                                     compare_opts)
             elif parts[0] == "DICTIONARY":
                 dict_fnames = [self.relpath(parts[1], 'dict')]
                 for mcu_dict in parts[2:]:
@@ -66,14 +142,20 @@ class TestCase:
                 gcode_fname = self.relpath(parts[1])
             elif parts[0] == "SHOULD_FAIL":
                 should_fail = True
+            elif parts[0] == "BINARY_REPLAY":
+                binary_replay = True
+            elif parts[0] == "COMPARE_CONFIG":
+                compare_fname = self.relpath(parts[1])
+                compare_opts = parts[2:]
             else:
                 gcode.append(line.strip())
         f.close()
         if not multi_tests:
             self.launch_test(config_fname, dict_fnames,
-                             gcode_fname, gcode, should_fail)
+                             gcode_fname, gcode, should_fail, binary_replay,
+                             compare_fname, compare_opts)
     def launch_test(self, config_fname, dict_fnames, gcode_fname, gcode,
-                    should_fail):
+                    should_fail, binary_replay, compare_fname, compare_opts):
         gcode_is_temp = False
         if gcode_fname is None:
             gcode_fname = self.relpath(TEMP_GCODE_FILE, 'temp')
@@ -90,8 +172,32 @@ class TestCase:
         # Call klippy
         sys.stderr.write("    Starting %s (%s)\n" % (
             self.fname, os.path.basename(config_fname)))
+        self.run_klippy(config_fname, dict_fnames, gcode_fname,
+                        TEMP_OUTPUT_FILE, should_fail)
+        if binary_replay:
+            self.check_binary_replay(config_fname, dict_fnames, gcode_fname,
+                                     should_fail)
+        if compare_fname is not None:
+            self.check_compare_config(compare_fname, dict_fnames, gcode_fname,
+                                      should_fail, compare_opts)
+        # Do cleanup
+        if self.keepfiles:
+            return
+        for fname in os.listdir(self.tempdir):
+            if fname.startswith(TEMP_OUTPUT_FILE):
+                os.unlink(fname)
+        if not self.verbose:
+            os.unlink(TEMP_LOG_FILE)
+        else:
+            sys.stderr.write('\n')
+        if gcode_is_temp:
+            os.unlink(gcode_fname)
+        if binary_replay:
+            os.unlink(self.relpath(TEMP_BINARY_FILE, 'temp'))
+    def run_klippy(self, config_fname, dict_fnames, gcode_fname, output_fname,
+                   should_fail):
         args = [ sys.executable, './klippy/klippy.py', config_fname,
-                 '-i', gcode_fname, '-o', TEMP_OUTPUT_FILE, '-v' ]
+                 '-i', gcode_fname, '-o', output_fname, '-v' ]
         for df in dict_fnames:
             args += ['-d', df]
         if not self.verbose:
@@ -104,18 +210,85 @@ class TestCase:
             if should_fail:
                 raise error("Test failed to raise an error")
             raise error("Error during test")
-        # Do cleanup
-        if self.keepfiles:
-            return
-        for fname in os.listdir(self.tempdir):
-            if fname.startswith(TEMP_OUTPUT_FILE):
-                os.unlink(fname)
-        if not self.verbose:
-            os.unlink(TEMP_LOG_FILE)
-        else:
-            sys.stderr.write('\n')
-        if gcode_is_temp:
-            os.unlink(gcode_fname)
+    def check_binary_replay(self, config_fname, dict_fnames, gcode_fname,
+                            should_fail):
+        # Replay the test from a binary g-code file and verify that the
+        # mcu output is identical to the output of the text file
+        sys.stderr.write("    Replaying %s from binary g-code\n" % (
+            self.fname,))
+        binary_fname = self.relpath(TEMP_BINARY_FILE, 'temp')
+        res = subprocess.call([sys.executable, './scripts/gcode_to_binary.py',
+                               '-c', gcode_fname, binary_fname])
+        if res:
+            raise error("Unable to convert gcode file to binary")
+        self.run_klippy(config_fname, dict_fnames, binary_fname,
+                        TEMP_BINARY_OUTPUT_FILE, should_fail)
+        for fname, binary_output, dict_fname in self.get_outputs(
+                dict_fnames, TEMP_BINARY_OUTPUT_FILE):
+            if not filecmp.cmp(fname, binary_output, shallow=False):
+                raise error("Binary replay output differs (%s)" % (fname,))
+    def check_compare_config(self, compare_fname, dict_fnames, gcode_fname,
+                             should_fail, compare_opts):
+        # Run the test with another config and verify that each stepper
+        # stops at the same positions.  With EXACT verify that each oid
+        # receives identical messages, and with TOLERANCE=<seconds>
+        # verify that each step is within the given time of the other
+        # config's step.
+        sys.stderr.write("    Comparing %s with %s\n" % (
+            self.fname, os.path.basename(compare_fname)))
+        self.run_klippy(compare_fname, dict_fnames, gcode_fname,
+                        TEMP_COMPARE_OUTPUT_FILE, should_fail)
+        for fname, compare_output, dict_fname in self.get_outputs(
+                dict_fnames, TEMP_COMPARE_OUTPUT_FILE):
+            mp = load_dictionary(dict_fname)
+            min_gap = int(STOP_TIME * float(mp.config['CLOCK_FREQ']))
+            streams = parse_output(fname, mp)
+            compare_streams = parse_output(compare_output, mp)
+            if "EXACT" in compare_opts:
+                if streams != compare_streams:
+                    raise error("Output differs from %s (%s)" % (
+                        os.path.basename(compare_fname), fname))
+                continue
+            tolerance = None
+            for opt in compare_opts:
+                if opt.startswith("TOLERANCE="):
+                    tolerance = int(float(opt[10:])
+                                    * float(mp.config['CLOCK_FREQ']))
+            for oid, msgs in sorted(streams.items()):
+                if not any(m.startswith('queue_step ') for m in msgs):
+                    continue
+                if tolerance is not None:
+                    self.check_step_times(oid, msgs,
+                                          compare_streams.get(oid, []),
+                                          tolerance)
+                stops = calc_stepper_stops(msgs, min_gap)
+                compare_stops = calc_stepper_stops(
+                    compare_streams.get(oid, []), min_gap)
+                if stops != compare_stops:
+                    raise error("Stepper oid=%d positions differ (%s vs %s)"
+                                % (oid, stops, compare_stops))
+    def check_step_times(self, oid, msgs, compare_msgs, tolerance):
+        steps = calc_step_clocks(msgs)
+        compare_steps = calc_step_clocks(compare_msgs)
+        if len(steps) != len(compare_steps):
+            raise error("Stepper oid=%d step count differs (%d vs %d)" % (
+                oid, len(steps), len(compare_steps)))
+        for i, ((clock, sdir), (cclock, csdir)) in enumerate(
+                zip(steps, compare_steps)):
+            diff = (clock - cclock) & 0xffffffff
+            if sdir != csdir or min(diff, 0x100000000 - diff) > tolerance:
+                raise error("Stepper oid=%d step %d differs (%d/%d vs %d/%d)"
+                            % (oid, i, clock, sdir, cclock, csdir))
+    def get_outputs(self, dict_fnames, other_output):
+        # Return the output file (and other_output file) of each mcu
+        # along with its dictionary
+        out = [(TEMP_OUTPUT_FILE, other_output, dict_fnames[0])]
+        for mcu_dict in dict_fnames[1:]:
+            mcu, fname = mcu_dict.split('=', 1)
+            suffix = "-" + mcu
+            out.append((TEMP_OUTPUT_FILE + suffix, other_output + suffix,
+                        fname))
+        return out
     def run(self):
         try:
             self.parse_test()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python2
+# Regression test for the toolhead.MoveQueue lazy lookahead early exit
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import toolhead, kinematics.extruder
+
+
+######################################################################
+# Reference planner
+######################################################################
+
+# The original lookahead that rescans the full queue on every flush
+class ReferenceMoveQueue(toolhead.MoveQueue):
+    def flush(self, lazy=False):
+        self.junction_flush = toolhead.LOOKAHEAD_FLUSH_TIME
+        update_flush_count = lazy
+        queue = self.queue
+        flush_count = len(queue)
+        delayed = []
+        next_end_v2 = next_smoothed_v2 = peak_cruise_v2 = 0.
+        for i in range(flush_count-1, -1, -1):
+            move = queue[i]
+            reachable_start_v2 = next_end_v2 + move.delta_v2
+            start_v2 = min(move.max_start_v2, reachable_start_v2)
+            reachable_smoothed_v2 = next_smoothed_v2 + move.smooth_delta_v2
+            smoothed_v2 = min(move.max_smoothed_v2, reachable_smoothed_v2)
+            if smoothed_v2 < reachable_smoothed_v2:
+                if (smoothed_v2 + move.smooth_delta_v2 > next_smoothed_v2
+                    or delayed):
+                    if update_flush_count and peak_cruise_v2:
+                        flush_count = i
+                        update_flush_count = False
+                    peak_cruise_v2 = min(move.max_cruise_v2, (
+                        smoothed_v2 + reachable_smoothed_v2) * .5)
+                    if delayed:
+                        if not update_flush_count and i < flush_count:
+                            mc_v2 = peak_cruise_v2
+                            for m, ms_v2, me_v2 in reversed(delayed):
+                                mc_v2 = min(mc_v2, ms_v2)
+                                m.set_junction(min(ms_v2, mc_v2), mc_v2
+                                               , min(me_v2, mc_v2))
+                        del delayed[:]
+                if not update_flush_count and i < flush_count:
+                    cruise_v2 = min((start_v2 + reachable_start_v2) * .5
+                                    , move.max_cruise_v2, peak_cruise_v2)
+                    move.set_junction(min(start_v2, cruise_v2), cruise_v2
+                                      , min(next_end_v2, cruise_v2))
+            else:
+                delayed.append((move, start_v2, next_end_v2))
+            next_end_v2 = start_v2
+            next_smoothed_v2 = smoothed_v2
+        if update_flush_count or not flush_count:
+            return
+        self.toolhead._process_moves(queue[:flush_count])
+        del queue[:flush_count]
+
+
+######################################################################
+# Lookahead statistics
+######################################################################
+
+# Move that counts accesses to its stored lazy lookahead state
+class CountingMove(toolhead.Move):
+    __slots__ = ('stats', 'stored_state')
+    def __init__(self, th, start_pos, end_pos, speed):
+        self.stats = th.stats
+        self.stored_state = None
+        toolhead.Move.__init__(self, th, start_pos, end_pos, speed)
+    def _get_state(self):
+        self.stats['reads'] += 1
+        return self.stored_state
+    def _set_state(self, state):
+        if state is not None:
+            self.stats['writes'] += 1
+        self.stored_state = state
+    lookahead_state = property(_get_state, _set_state)
+
+# Move queue that counts the moves walked by each flush
+class CountingMoveQueue(toolhead.MoveQueue):
+    def flush(self, lazy=False):
+        stats = self.toolhead.stats
+        queue_len = len(self.queue)
+        reads, writes = stats['reads'], stats['writes']
+        toolhead.MoveQueue.flush(self, lazy)
+        stats['ref_walked'] += queue_len
+        reads, writes = stats['reads'] - reads, stats['writes'] - writes
+        if reads > writes:
+            # The pass stopped at a move with a converged state
+            stats['exits'] += 1
+            stats['walked'] += reads
+        else:
+            stats['walked'] += queue_len
+
+def new_stats():
+    return {'reads': 0, 'writes': 0, 'exits': 0,
+            'walked': 0, 'ref_walked': 0}
+
+
+######################################################################
+# Minimal toolhead
+######################################################################
+
+class DummyToolHead:
+    def __init__(self, mq_class, max_velocity, max_accel, flush_time,
+                 move_class=toolhead.Move):
+        self.max_velocity = max_velocity
+        self.max_accel = max_accel
+        self.max_accel_to_decel = max_accel * .5
+        scv2 = 5.**2
+        self.junction_deviation = scv2 * (math.sqrt(2.) - 1.) / max_accel
+        self.extruder = kinematics.extruder.DummyExtruder(None)
+        self.flush_time = flush_time
+        self.move_queue = mq_class(self)
+        self.move_queue.set_flush_time(flush_time)
+        self.move_class = move_class
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.results = []
+        self.stats = new_stats()
+    def _process_moves(self, moves):
+        for m in moves:
+            self.results.append((m.start_v, m.cruise_v, m.end_v,
+                                 m.accel_t, m.cruise_t, m.decel_t))
+    def move(self, newpos, speed):
+        move = self.move_class(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        self.commanded_pos[:] = move.end_pos
+        self.move_queue.add_move(move)
+    def flush(self):
+        self.move_queue.flush()
+        self.move_queue.set_flush_time(self.flush_time)
+
+
+######################################################################
+# G-Code replay
+######################################################################
+
+def parse_gcode(filename):
+    moves = []
+    absolute_coord = absolute_extrude = True
+    pos = [0., 0., 0., 0.]
+    speed = 25.
+    f = open(filename, 'rb')
+    for line in f:
+        line = line.split(';', 1)[0].strip().upper()
+        parts = line.split()
+        if not parts:
+            continue
+        cmd = parts[0]
+        params = {}
+        for p in parts[1:]:
+            try:
+                params[p[0]] = float(p[1:])
+            except ValueError:
+                pass
+        if cmd in ('G0', 'G1'):
+            newpos = list(pos)
+            for i, axis in enumerate('XYZE'):
+                if axis not in params:
+                    continue
+                v = params[axis]
+                if (absolute_coord if i < 3 else absolute_extrude):
+                    newpos[i] = v
+                else:
+                    newpos[i] += v
+            if 'F' in params and params['F'] > 0.:
+                speed = params['F'] / 60.
+            moves.append((newpos, speed))
+            pos = newpos
+        elif cmd == 'G28':
+            pos = [0., 0., 0., pos[3]]
+            moves.append((list(pos), None))
+        elif cmd == 'G92':
+            for i, axis in enumerate('XYZE'):
+                if axis in params:
+                    pos[i] = params[axis]
+            moves.append((list(pos), None))
+        elif cmd in ('G4', 'M400'):
+            moves.append((list(pos), None))
+        elif cmd == 'G90':
+            absolute_coord = absolute_extrude = True
+        elif cmd == 'G91':
+            absolute_coord = absolute_extrude = False
+        elif cmd == 'M82':
+            absolute_extrude = True
+        elif cmd == 'M83':
+            absolute_extrude = False
+    f.close()
+    return moves
+
+def segment_moves(moves, seg_dist):
+    out = []
+    pos = [0., 0., 0., 0.]
+    for newpos, speed in moves:
+        if speed is None:
+            out.append((newpos, speed))
+            pos = newpos
+            continue
+        dist = math.sqrt(sum([(n - p)**2 for n, p in zip(newpos, pos)[:3]]))
+        count = max(1, int(dist / seg_dist))
+        for i in range(1, count + 1):
+            r = float(i) / count
+            out.append(([p + (n - p) * r for n, p in zip(newpos, pos)], speed))
+        pos = newpos
+    return out
+
+def replay(moves, mq_class, max_velocity, max_accel, flush_time,
+           move_class=toolhead.Move):
+    th = DummyToolHead(mq_class, max_velocity, max_accel, flush_time,
+                       move_class)
+    for newpos, speed in moves:
+        if speed is None:
+            # Flush and set position (G28, G92, G4, M400)
+            th.flush()
+            th.commanded_pos[:] = newpos
+            continue
+        th.move(newpos, speed)
+    th.flush()
+    return th.results, th.stats
+
+
+
+
+######################################################################
+# Generated move sequences
+######################################################################
+
+# Straight moves along the sides of a square, each side split into
+# segments.  With a low acceleration the toolhead accelerates over
+# many lazy lookahead passes along each side.
+def square_moves(seg_dist, side, sides, speed):
+    moves = []
+    pos = [0., 0.]
+    count = int(side / seg_dist + .5)
+    for i in range(sides):
+        axis, sign = i % 2, 1. - 2. * ((i // 2) % 2)
+        for j in range(count):
+            pos[axis] += sign * seg_dist
+            moves.append(([pos[0], pos[1], 0., 0.], speed))
+    return moves
+
+GENERATED_TESTS = [
+    # desc, moves, max_velocity, max_accel
+    ("long ramps", square_moves(2., 2000., 4, 500.), 500., 100.),
+    ("low accel", square_moves(1., 1000., 4, 500.), 500., 100.),
+    ("short segments", square_moves(.5, 500., 4, 500.), 500., 500.),
+]
+
+def check_replay(desc, moves, max_velocity, max_accel, flush_times):
+    total = new_stats()
+    for flush_time in flush_times:
+        ref, ref_stats = replay(moves, ReferenceMoveQueue,
+                                max_velocity, max_accel, flush_time)
+        res, stats = replay(moves, CountingMoveQueue, max_velocity,
+                            max_accel, flush_time, CountingMove)
+        if ref != res:
+            sys.stderr.write(
+                "\n\nTest case %s FAILED (velocity=%.1f accel=%.1f"
+                " flush_time=%.3f)!\n\n" % (
+                    desc, max_velocity, max_accel, flush_time))
+            sys.exit(-1)
+        for name, value in stats.items():
+            total[name] += value
+    return total
+
+def report(desc, move_count, stats):
+    sys.stderr.write("    Replayed %s (%d moves, %d converged exits,"
+                     " walked %d of %d moves)\n" % (
+                         desc, move_count, stats['exits'], stats['walked'],
+                         stats['ref_walked']))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] [gcode files]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-s", "--segment", type="float", dest="segment",
+                    default=0.1, help="also replay moves split into"
+                    " segments of this length (in mm)")
+    options, args = opts.parse_args()
+
+    # Generated moves that must reach the converged state exit
+    for desc, moves, max_velocity, max_accel in GENERATED_TESTS:
+        stats = check_replay(desc, moves, max_velocity, max_accel,
+                             [0.250, 2.000])
+        report(desc, len(moves), stats)
+        if not stats['exits']:
+            sys.stderr.write("\n\nTest case %s FAILED (lookahead state"
+                             " never converged)!\n\n" % (desc,))
+            sys.exit(-1)
+
+    for fname in args:
+        moves = parse_gcode(fname)
+        tests = [("", moves)]
+        if options.segment:
+            tests.append((" (segmented)",
+                          segment_moves(moves, options.segment)))
+        for desc, test_moves in tests:
+            total = new_stats()
+            for max_velocity, max_accel in [(300., 3000.), (500., 500.)]:
+                stats = check_replay(fname + desc, test_moves, max_velocity,
+                                     max_accel, [0.250, 2.000, 10.000])
+                for name, value in stats.items():
+                    total[name] += value
+            report(fname + desc, len(test_moves), total)
+
+    sys.stderr.write("\n    All %d lookahead tests passed\n" % (
+        len(GENERATED_TESTS) + len(args),))
+
+if __name__ == '__main__':
+    main()
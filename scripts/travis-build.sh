@@ -70,3 +70,7 @@ mkdir -p ${HOSTDIR}
 start_test klippy "Test invoke klippy"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy"
+
+start_test lookahead "Test lookahead planner"
+$PYTHON scripts/test_lookahead.py test/klippy/*.gcode
+finish_test lookahead "Test lookahead planner"